@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Concurrent handler throughput of database.DB: worker threads replay the DB calls of a private message
+# while one thread keeps running a slow full-page read, like a busy /stats or "show all" would.
+# Run from the repository root with a config.py in place: python bench/handlers.py [threads...]
+
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402 isort:skip
+
+Users = 200
+Requests = 5000
+UpdatesPerThread = 500
+SlowPageSize = 2000
+
+
+def seed(db):
+    now = datetime.now()
+    for u in range(Users):
+        db.AddUser("user{0}".format(u))
+    for i in range(Requests):
+        db.AddRequest("user{0}".format(i % Users), i % 2, 10 ** 6, "BTS", "bank", 0.5, now, now + timedelta(days=30))
+
+
+def handle_update(db, u, reqId):
+    username = "user{0}".format(u)
+    db.IsUserInBlacklist(u + 1)
+    db.IsUserRegistered(username)
+    db.SetUserChatId(username, 1000 + u)
+    db.GetUserChatId(username)
+    db.GetRequest(reqId, username)
+
+
+def run(db, threads):
+    latencies = []
+    latenciesLock = threading.Lock()
+    stop = threading.Event()
+
+    def slow_reader():
+        while not stop.is_set():
+            db.GetAllFormattedRequests("user0", 0, SlowPageSize)
+
+    def worker(idx):
+        local = []
+        for i in range(UpdatesPerThread):
+            started = time.perf_counter()
+            handle_update(db, (idx * UpdatesPerThread + i) % Users, 1 + (i * 7919) % Requests)
+            local.append(time.perf_counter() - started)
+        with latenciesLock:
+            latencies.extend(local)
+
+    reader = threading.Thread(target=slow_reader, daemon=True)
+    reader.start()
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(idx,)) for idx in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    reader.join()
+    latencies.sort()
+    print(
+        "{0} threads: {1:.0f} updates/s, p50 {2:.2f} ms, p99 {3:.2f} ms".format(
+            threads,
+            len(latencies) / elapsed,
+            latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000,
+        )
+    )
+
+
+def main():
+    threadCounts = [int(arg) for arg in sys.argv[1:]] or [1, 4, 8]
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DBFileName = os.path.join(tmp, "bench.sqlite")
+        db = database.DB()
+        seed(db)
+        for threads in threadCounts:
+            run(db, threads)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# Memory per idle session and per cached request, measured with tracemalloc over many objects.
+# Run from the repository root with a config.py in place: python bench/memory.py [count]
+
+import gc
+import os
+import sys
+import tempfile
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402 isort:skip
+from user_request_process import UserRequestProcess  # noqa: E402 isort:skip
+
+
+class DictSession:
+    # the same attributes in a per-instance __dict__, the layout sessions had before __slots__
+    pass
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    objects = build()
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return size / len(objects), objects
+
+
+def as_dict_session(process):
+    session = DictSession()
+    for name in UserRequestProcess.__slots__:
+        attr = "_UserRequestProcess" + name if name.startswith("__") else name
+        setattr(session, attr, getattr(process, attr))
+    return session
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DBFileName = os.path.join(tmp, "bench.sqlite")
+        db = database.DB()
+        usernames = ["user{0}".format(u) for u in range(count)]
+
+        slotted, processes = measure(lambda: [UserRequestProcess(None, db, None, None, u, 1000) for u in usernames])
+        dictBased, _ = measure(lambda: [as_dict_session(p) for p in processes])
+        print("idle session: {0:.0f} bytes per user with __slots__, {1:.0f} with __dict__".format(slotted, dictBased))
+
+        now = datetime.now()
+        with db.Transaction():
+            for i in range(count):
+                db.AddRequest(usernames[i], i % 2, (i + 1) * 10 ** 6, "BTS", "bank {0}".format(i % 100), 0.5, now, now)
+        db.cur.execute("SELECT * FROM requests")
+        rows, _ = measure(lambda: db.cur.fetchall())
+        db.cur.execute("SELECT * FROM requests")
+        records, _ = measure(lambda: [database.Request.FromRow(r) for r in db.cur.fetchall()])
+        print("cached request: {0:.0f} bytes as a sqlite row, {1:.0f} as a Request".format(rows, records))
+        db.cur.execute("SELECT * FROM requests")
+        parsed, _ = measure(
+            lambda: [
+                (r[0], r[1], r[2], r[3], r[4], r[5], r[6], database.parse_date(r[7]), database.parse_date(r[8]))
+                for r in db.cur.fetchall()
+            ]
+        )
+        print("cached request: {0:.0f} bytes as a tuple with parsed dates".format(parsed))
+
+
+if __name__ == '__main__':
+    main()
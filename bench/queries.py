@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# Per-call latency of frequent database.DB calls, looked up for many different users like a live bot does.
+# Run from the repository root with a config.py in place: python bench/queries.py
+
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402 isort:skip
+
+Users = 1000
+Calls = 20000
+
+
+def measure(name, call, count):
+    started = time.perf_counter()
+    for i in range(count):
+        call(i)
+    print("{0}: {1:.1f} us/call".format(name, (time.perf_counter() - started) / count * 10 ** 6))
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DBFileName = os.path.join(tmp, "bench.sqlite")
+        db = database.DB()
+        usernames = ["user{0}".format(u) for u in range(Users)]
+        for username in usernames:
+            db.AddUser(username)
+        now = datetime.now()
+        end = now + timedelta(days=30)
+        measure("IsUserRegistered", lambda i: db.IsUserRegistered(usernames[(i * 7919) % Users]), Calls)
+        measure("GetUserChatId", lambda i: db.GetUserChatId(usernames[(i * 7919) % Users]), Calls)
+        measure(
+            "AddRequest",
+            lambda i: db.AddRequest(usernames[i % Users], i % 2, 10 ** 6, "BTS", "bank", 0.5, now, end),
+            Calls // 10,
+        )
+
+
+if __name__ == '__main__':
+    main()
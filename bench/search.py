@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# DB.SearchRequests over a seeded requests table: every search shape is checked for a temp b-tree in its query
+# plan and for the same first pages as a brute-force filter and sort, then typical /search commands are timed.
+# Run from the repository root with a config.py in place: python bench/search.py [rows]
+
+import itertools
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402 isort:skip
+from database import FeeFilter, RequestType  # noqa: E402 isort:skip
+from request_search import RequestSearch  # noqa: E402 isort:skip
+
+PageSize = 5
+Pages = 3
+Repeats = 200
+Commands = [
+    "/search BTS",
+    "/search BTS 100-500",
+    "/search BTS fee:buyer",
+    "/search BTS sell fee:buyer",
+    "/search BTS fee<=1",
+    "/search BTS fee:seller sort:fee",
+    "/search BTS sell sort:fee",
+    "/search BTS fee:none sort:fee",
+]
+
+
+def seed(count):
+    random.seed(1)
+    fees = [-2, -1, -0.5, 0, 0, 0.5, 1, 2]
+    return [
+        (
+            i,
+            "user{0}".format(i % 300),
+            i % 2,
+            random.randrange(1, 1000) * 10 ** 6,
+            random.choice(["BTS", "BTC"]),
+            "bank",
+            random.choice(fees),
+            "2026-10-18 00:00:00",
+            "2026-12-18 00:00:00",
+        )
+        for i in range(1, count + 1)
+    ]
+
+
+def brute_force(rows, search):
+    def matches(r):
+        fee = r[6]
+        if r[4] != search.currency:
+            return False
+        if search.requestType is not None and r[2] != search.requestType:
+            return False
+        if search.minQuantity is not None and r[3] < search.minQuantity:
+            return False
+        if search.maxQuantity is not None and r[3] > search.maxQuantity:
+            return False
+        if search.feeFilter == FeeFilter.Nobody and fee != 0:
+            return False
+        if search.feeFilter == FeeFilter.Buyer and not fee > 0:
+            return False
+        if search.feeFilter == FeeFilter.Seller and not fee < 0:
+            return False
+        if search.maxFee is not None and search.feeFilter != FeeFilter.Nobody and abs(fee) > search.maxFee:
+            return False
+        return True
+
+    found = [r for r in rows if matches(r)]
+    if search.sortByFee:
+        found.sort(key=lambda r: (r[6], r[0]), reverse=not search.feeAscending)
+    else:
+        found.sort(key=lambda r: r[0], reverse=True)
+    return [r[0] for r in found]
+
+
+def next_cursor(search, page):
+    return (page[-1].fee, page[-1].id) if search.sortByFee else (page[-1].id,)
+
+
+def check(db, rows):
+    statements = set()
+    db.conn.set_trace_callback(lambda sql: statements.add(sql) if sql.startswith("SELECT * FROM requests") else None)
+    mismatches = 0
+    shapes = itertools.product(
+        [None, RequestType.Buy, RequestType.Sell],
+        [None, 100 * 10 ** 6],
+        [None, 500 * 10 ** 6],
+        list(FeeFilter),
+        [None, 1.0],
+        [False, True],
+    )
+    searches = [RequestSearch("BTS", *shape) for shape in shapes]
+    for search in searches:
+        expected = brute_force(rows, search)[: PageSize * Pages]
+        found = []
+        cursor = None
+        for _ in range(Pages):
+            page = db.SearchRequests(search, cursor, PageSize)
+            if len(page) == 0:
+                break
+            found.extend(req.id for req in page)
+            cursor = next_cursor(search, page)
+        if found != expected:
+            mismatches += 1
+            print("mismatch: {0}".format(search.GetState()))
+    db.conn.set_trace_callback(None)
+
+    sorted_in_temp = 0
+    for sql in statements:
+        # the traced text has its parameters inlined on newer Pythons; elsewhere they are bound as NULL
+        plan = db.conn.execute("EXPLAIN QUERY PLAN " + sql, [None] * sql.count("?")).fetchall()
+        if any("TEMP B-TREE" in step[3] for step in plan):
+            sorted_in_temp += 1
+            print("temp b-tree: {0}".format(sql))
+    print(
+        "{0} searches, {1} mismatches against brute force, {2} of {3} statements sort in a temp b-tree".format(
+            len(searches), mismatches, sorted_in_temp, len(statements)
+        )
+    )
+    return mismatches == 0 and sorted_in_temp == 0
+
+
+def timings(db):
+    for text in Commands:
+        search = RequestSearch.Parse(text, ["BTS"])
+        page = db.SearchRequests(search, None, PageSize + 1)
+        for name, cursor in (("first", None), ("next", next_cursor(search, page))):
+            started = time.perf_counter()
+            for _ in range(Repeats):
+                db.SearchRequests(search, cursor, PageSize + 1)
+            elapsed = (time.perf_counter() - started) / Repeats
+            print("{0:<34} {1:<5} page: {2:.3f} ms".format(text, name, elapsed * 1000))
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as tmp:
+        database.DBFileName = os.path.join(tmp, "bench.sqlite")
+        db = database.DB()
+        rows = seed(count)
+        db.ImportTable("requests", rows)
+        ok = check(db, rows)
+        timings(db)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# Write path throughput of database.DB: worker threads commit concurrently, each commit waits for its own fsync
+# unless --synchronous NORMAL is given. Use --dir to measure on the disk that holds the real database.
+# Run from the repository root with a config.py in place: python bench/writes.py [--synchronous MODE] [threads...]
+
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402 isort:skip
+
+Users = 2000
+OpsPerThread = 250
+
+
+def register_unchanged(db, idx, i):
+    # a private message from a known user: RegisterUser only reads
+    u = (idx * OpsPerThread + i) % Users
+    db.RegisterUser("user{0}".format(u), u + 1, 1000 + u)
+
+
+def register_changed(db, idx, i):
+    # a private message from a user whose chat id changed: one commit
+    u = (idx * OpsPerThread + i) % Users
+    db.RegisterUser("user{0}".format(u), u + 1, 10 ** 6 + idx * OpsPerThread + i)
+
+
+def add_request(db, idx, i):
+    # a new request: one commit
+    now = datetime.now()
+    db.AddRequest("user{0}".format(i % Users), i % 2, 10 ** 6, "BTS", "bank", 0.5, now, now + timedelta(days=30))
+
+
+def run(db, name, op, commitsPerOp, threads):
+    latencies = []
+    latenciesLock = threading.Lock()
+
+    def worker(idx):
+        local = []
+        for i in range(OpsPerThread):
+            started = time.perf_counter()
+            op(db, idx, i)
+            local.append(time.perf_counter() - started)
+        with latenciesLock:
+            latencies.extend(local)
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(idx,)) for idx in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    print(
+        "{0}, {1} threads: {2:.0f} ops/s, {3:.0f} commits/s, p50 {4:.2f} ms, p99 {5:.2f} ms".format(
+            name,
+            threads,
+            len(latencies) / elapsed,
+            len(latencies) * commitsPerOp / elapsed,
+            latencies[len(latencies) // 2] * 1000,
+            latencies[int(len(latencies) * 0.99)] * 1000,
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("threads", type=int, nargs="*", default=[1, 4, 8])
+    parser.add_argument("--synchronous", default=database.DB.Synchronous, choices=("FULL", "NORMAL"))
+    parser.add_argument("--dir", default=None, help="directory for the benchmark database")
+    args = parser.parse_args()
+    database.DB.Synchronous = args.synchronous
+    print("synchronous={0}".format(args.synchronous))
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        database.DBFileName = os.path.join(tmp, "bench.sqlite")
+        db = database.DB()
+        for u in range(Users):
+            db.RegisterUser("user{0}".format(u), u + 1, 1000 + u)
+        for threads in args.threads:
+            run(db, "private message, unchanged user", register_unchanged, 0, threads)
+        for threads in args.threads:
+            run(db, "private message, changed chat id", register_changed, 1, threads)
+        for threads in args.threads:
+            run(db, "AddRequest", add_request, 1, threads)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,17 +1,24 @@
 #!/usr/bin/env python
 
 import logging
-import threading
-import time
+from urllib.parse import urlparse
 
 import telebot
 from telebot import apihelper
-from telebot.types import Message
+from telebot.types import ChatMemberUpdated, Message
 
 import config
 import database
 import localizationdic as ld
+from chat_admins import MasterChatAdmins
+from dispatcher import UpdateDispatcher
+from expiry_scheduler import ExpiryScheduler
+from matching_engine import MatchingEngine
+from notifier import Notifier
+from session_store import SessionStore
+from timer_service import TimerService
 from user_request_process import RequestSteps, UserRequestProcess
+from webhook import WebhookServer
 
 logger = telebot.logger
 telebot.logger.setLevel(logging.INFO)
@@ -24,59 +31,121 @@ log.addHandler(handler)
 log.setLevel(logging.DEBUG)
 
 apihelper.proxy = config.proxy
-bot = telebot.TeleBot(config.token)
+webhookConfig = getattr(config, "webhook", None)
+# handlers only hand updates over to the dispatcher, so telebot's own worker pool is not needed
+bot = telebot.TeleBot(config.token, threaded=False)
 db = database.DB()
+notifier = Notifier(bot, db)
+dispatcher = UpdateDispatcher()
 
-masterChatId = db.GetMasterChatId()
-masterChatAdmins = []
-userProcesses = {}
+masterChat = MasterChatAdmins(bot, db)
+allowedUpdates = ["message", "callback_query", "chat_member"]
+timers = TimerService()
+userProcesses = SessionStore(bot, db, notifier, timers)
 
-# if masterChatId != 0:
-#     try:
-#         masterChatAdmins = bot.get_chat_administrators(masterChatId)
-#     except:
-#         masterChatAdmins = []
-#         masterChatId = 0
-# else:
-#     masterChatAdmins = []
 
+BlacklistedMessage = """Вы в черном списке!
+You are in blacklist!"""
+SetUsernameMessage = """Вам сначала нужно установить никнейм в телеграме.
+You need to set your username in Telegram first."""
 
-def clean_db():
-    while True:
-        log.info("DB cleaning")
-        db.DeleteOldRequests()
-        time.sleep(86400)
+
+def notify_expired(rows):
+    for req in rows:
+        try:
+            chatId = db.GetUserChatId(req.username)
+        except Exception:
+            continue
+        if chatId:
+            notifier.Notify([chatId], ld.get_translate(db, req.username, ld.RequestExpiredKey).format(req.id))
+
+
+def expire_claim(reqId):
+    # the claim may have been finished or replaced meanwhile, only an expired one is released
+    claimant = db.ReleaseExpiredProcessingRequest(reqId)
+    if claimant is None:
+        return
+    log.info("Processing request #{0} was deleted".format(reqId))
+    chatId = db.GetUserChatId(claimant)
+    if chatId:
+        notifier.Notify([chatId], ld.get_translate(db, claimant, ld.AcceptRequestHasBeenAutoCancelledKey))
+
+
+def schedule_claims():
+    # claims outlive restarts in processing_requests, their timers are rebuilt from expiresAt
+    timers.Register(UserRequestProcess.AcceptTimerKind, expire_claim)
+    for reqId, expiresAt in db.GetProcessingRequestsExpiry():
+        timers.Schedule(UserRequestProcess.AcceptTimerKind, reqId, expiresAt)
+    timers.Start()
+
+
+expiryScheduler = ExpiryScheduler(
+    db, timers, notify_expired if getattr(config, "notify_expired_requests", False) else None
+)
+
+
+def notify_match(order, counterOrders):
+    # both owners hear about the match: the new order's owner gets every counter-order and each
+    # counter-order's owner gets the new one
+    reqId, owner = order
+    ownerChatId = db.GetUserChatId(owner)
+    for counterReqId, counterOwner in counterOrders:
+        counterChatId = db.GetUserChatId(counterOwner)
+        if ownerChatId:
+            text = ld.get_translate(db, owner, ld.MatchFoundKey)
+            notifier.Notify([ownerChatId], text.format(reqId, db.GetRequest(counterReqId, owner)))
+        if counterChatId:
+            text = ld.get_translate(db, counterOwner, ld.MatchFoundKey)
+            notifier.Notify([counterChatId], text.format(counterReqId, db.GetRequest(reqId, counterOwner)))
+
+
+matchingEngine = MatchingEngine(db, notify_match)
 
 
 @bot.message_handler(content_types=["text"])
 def handle_messages(message: Message):
+    dispatcher.Submit(message.from_user.id, process_message, message)
+
+
+@bot.callback_query_handler(func=lambda call: True)
+def handle_callback_query(call):
+    dispatcher.Submit(call.from_user.id, process_callback_query, call)
+
+
+def process_message(message: Message):
     if message.chat.type == "supergroup" or message.chat.type == "group":
         handle_group_message(message)
     elif message.chat.type == "private":
         handle_private_message(message)
 
 
-@bot.callback_query_handler(func=lambda call: True)
-def handle_callback_query(call):
+def process_callback_query(call):
     data = call.data
     username = call.from_user.username
     log.info('callback query from %s: %s', username, data)
-    if not (username in userProcesses):
-        userProcesses[username] = UserRequestProcess(bot, db, username, call.message.chat.id)
-
-    userProcesses[username].ProcessMessage(data)
+    req = userProcesses.Get(username, call.message.chat.id)
+    req.ProcessMessage(data)
+    userProcesses.Save(req)
     try:
         bot.answer_callback_query(call.id)
     except Exception as ex:
         log.info("Exception during request {0} from {1}. Message: {2}".format(data, username, str(ex)))
 
 
+@bot.chat_member_handler()
+def handle_chat_member(update: ChatMemberUpdated):
+    if update.chat.id != masterChat.masterChatId:
+        return
+    statuses = {update.old_chat_member.status, update.new_chat_member.status}
+    if "administrator" in statuses or "creator" in statuses:
+        log.info("master chat administrators changed")
+        masterChat.Invalidate()
+
+
 def handle_group_message(message: Message):
-    masterChatId = db.GetMasterChatId()
-    if masterChatId != 0:
-        masterChatAdmins = bot.get_chat_administrators(masterChatId)
-    else:
-        masterChatAdmins = []
+    if not message.text.startswith("/"):
+        return
+    masterChatId = masterChat.masterChatId
 
     if message.text.startswith("/setmasterchat"):
         if masterChatId != 0 and (masterChatId != message.chat.id):
@@ -90,17 +159,17 @@ Set 'username' first please""",
             return
         if masterChatId == 0:
             masterChatId = message.chat.id
-            masterChatAdmins = bot.get_chat_administrators(masterChatId)
-            administrators = [user.user.username for user in masterChatAdmins]
+            administrators = masterChat.FetchAdmins(masterChatId)
             if message.from_user.username not in administrators:
-                masterChatId = 0
-                masterChatAdmins = []
                 return
+        else:
+            administrators = masterChat.GetAdmins()
         log.info("setting masterchat by %s request", message.from_user.username)
-        db.SetMasterChatId(masterChatId)
+        masterChat.SetMasterChatId(masterChatId, administrators)
         bot.send_message(masterChatId, "Done")
     elif message.text.startswith("/list"):
-        if masterChatId == 0 or len(masterChatAdmins) == 0:
+        administrators = masterChat.GetAdmins()
+        if masterChatId == 0 or len(administrators) == 0:
             return
         if not message.from_user.username or len(message.from_user.username) == 0:
             bot.send_message(
@@ -109,7 +178,6 @@ Set 'username' first please""",
 Set 'username' first please""",
             )
             return
-        administrators = [user.user.username for user in masterChatAdmins]
         if message.from_user.username not in administrators:
             return
         reqList = db.GetAllFormattedRequests(message.from_user.username, 0, 50)
@@ -152,7 +220,8 @@ Set 'username' first please""",
             ),
         )
     elif message.text.startswith("/unregister"):
-        if masterChatId == 0 or len(masterChatAdmins) == 0:
+        administrators = masterChat.GetAdmins()
+        if masterChatId == 0 or len(administrators) == 0:
             return
         if not message.from_user.username or len(message.from_user.username) == 0:
             bot.send_message(
@@ -161,7 +230,6 @@ Set 'username' first please""",
 Set 'username' first please""",
             )
             return
-        administrators = [user.user.username for user in masterChatAdmins]
         if message.from_user.username not in administrators:
             return
         username = message.text.replace("/unregister", "").strip(' ').strip('@')
@@ -176,7 +244,9 @@ Please, enter command as <b>/unregister 'username'</b>""",
         if not db.IsUserRegistered(username):
             bot.send_message(message.chat.id, "User {0} is not registered".format(username))
             return
-        db.DeleteUser(username)
+        with db.Transaction():
+            db.DeleteUser(username)
+            userProcesses.Remove(username)
         bot.send_message(message.chat.id, "User {0} was deleted".format(username))
     elif message.text.startswith("/escrowlist"):
         escrowList = db.GetEscrowList()
@@ -186,7 +256,8 @@ Please, enter command as <b>/unregister 'username'</b>""",
         result = "\n".join(escrowList)
         bot.send_message(message.chat.id, result, parse_mode="HTML")
     elif message.text.startswith("/stats"):
-        if masterChatId == 0 or len(masterChatAdmins) == 0:
+        administrators = masterChat.GetAdmins()
+        if masterChatId == 0 or len(administrators) == 0:
             return
         if not message.from_user.username or len(message.from_user.username) == 0:
             bot.send_message(
@@ -195,15 +266,49 @@ Please, enter command as <b>/unregister 'username'</b>""",
 Set 'username' first please""",
             )
             return
-        administrators = [user.user.username for user in masterChatAdmins]
         if message.from_user.username not in administrators:
             return
         usersCount = db.GetUsersCount()
         usersWithNotif = db.GetUsersCountWithNotifications()
-        result = "\nusers: {0}\nwith notifications: {1}".format(usersCount, usersWithNotif)
+        langCache = db.languageCache
+        result = "\nusers: {0}\nwith notifications: {1}\nlanguage cache: {2} entries, {3} hits, {4} misses".format(
+            usersCount, usersWithNotif, len(langCache), langCache.hits, langCache.misses
+        )
+        renderer = db.requestRenderer
+        result += "\nrendered cards: {0} cached, {1} hits, {2} misses".format(
+            len(renderer), renderer.hits, renderer.misses
+        )
+        notifMetrics = notifier.GetMetrics()
+        result += (
+            "\nnotifications: {queued} queued, {inFlight} in flight, {sent} sent, {failed} failed, "
+            "{retried} retried, {unsubscribed} unsubscribed"
+            "\nnotification latency: avg {latencyAvg:.2f}s, p95 {latencyP95:.2f}s, max {latencyMax:.2f}s"
+        ).format(**notifMetrics)
+        result += "\nsessions: {0} in memory, {1} hits, {2} restored, {3} evicted".format(
+            len(userProcesses), userProcesses.hits, userProcesses.restored, userProcesses.evicted
+        )
+        for currency, reqType, count, volume in db.GetOpenVolume():
+            result += "\nopen {0} {1}: {2} requests, {3}".format(
+                reqType.name.lower(), currency, count, database.format_quantity(volume)
+            )
+        result += (
+            "\ntimers: {pending} pending, {fired} fired, {cancelled} cancelled, "
+            "lag avg {lagAvg:.3f}s, max {lagMax:.3f}s"
+        ).format(**timers.GetMetrics())
+        result += "\nmatching: {0} open orders, {1} matches found".format(
+            matchingEngine.GetOrdersCount(), matchingEngine.matchesFound
+        )
+        for shard in dispatcher.GetMetrics():
+            result += "\ndispatcher shard {shard}: {queued} queued, {processed} processed, {failed} failed".format(
+                **shard
+            )
+            result += ", latency " + " ".join(
+                "<={0}s:{1}".format(bound, count) for bound, count in zip(dispatcher.LatencyBuckets, shard["histogram"])
+            )
         bot.send_message(message.chat.id, result)
     elif message.text.startswith("/blockbyreqid"):
-        if masterChatId == 0 or len(masterChatAdmins) == 0:
+        administrators = masterChat.GetAdmins()
+        if masterChatId == 0 or len(administrators) == 0:
             return
         if not message.from_user.username or len(message.from_user.username) == 0:
             bot.send_message(
@@ -212,7 +317,6 @@ Set 'username' first please""",
 Set 'username' first please""",
             )
             return
-        administrators = [user.user.username for user in masterChatAdmins]
         if message.from_user.username not in administrators:
             return
         reqId = message.text.replace("/blockbyreqid", "").strip(' ').strip('@')
@@ -241,48 +345,66 @@ Please, enter command as <b>/blockbyreqid 'req id'</b>""",
 def handle_private_message(message: Message):
     log.info('private message from %s: %s', message.from_user.username, message.text)
     if db.IsUserInBlacklist(message.from_user.id):
-        bot.send_message(
-            message.chat.id,
-            """Вы в черном списке!
-You are in blacklist!""",
-        )
+        bot.send_message(message.chat.id, BlacklistedMessage)
         return
     if message.from_user.username is None or len(message.from_user.username) == 0:
-        bot.send_message(
-            message.chat.id,
-            """Вам сначала нужно установить никнейм в телеграме.
-You need to set your username in Telegram first.""",
-        )
+        bot.send_message(message.chat.id, SetUsernameMessage)
         return
 
-    username = message.from_user.username
-    if not db.IsUserRegistered(username):
-        db.AddUser(username)
+    db.RegisterUser(message.from_user.username, message.from_user.id, message.chat.id)
+    process_session_message(message)
 
-    db.SetUserChatId(username, message.chat.id)
-    db.UpdateUser(username, message.from_user.id)
+
+def process_session_message(message: Message):
+    username = message.from_user.username
+    isCommand = message.text.startswith("/start") or message.text.startswith("/search")
+    req = userProcesses.Get(username, message.chat.id if isCommand else None)
     if message.text.startswith("/start"):
-        if not (username in userProcesses):
-            userProcesses[username] = UserRequestProcess(bot, db, username, message.chat.id)
-        req = userProcesses[username]
         if req.currentStep == RequestSteps.Start:
             req.Start()
         else:
             req.ProcessMessage("/start")
-    elif (username in userProcesses) and (
-        (userProcesses[username].currentStep != RequestSteps.Start) or message.text == "⬅️" or message.text == "➡️"
+        userProcesses.Save(req)
+    elif (req is not None) and (
+        (req.currentStep != RequestSteps.Start)
+        or message.text == "⬅️"
+        or message.text == "➡️"
+        or message.text.startswith("/search")
     ):
-        userProcesses[username].ProcessMessage(message.text)
+        req.ProcessMessage(message.text)
+        userProcesses.Save(req)
     else:
         usage = """<b>Использование:</b>
 /start   - Начало процесса
+/search  - Поиск заявок
 
 <b>Usage:</b>
-/start - start process"""
+/start - start process
+/search - search requests"""
         bot.send_message(message.chat.id, usage, parse_mode="HTML")
 
 
 if __name__ == '__main__':
-    cleaner = threading.Thread(target=clean_db, daemon=True)
-    cleaner.start()
-    bot.polling(none_stop=True, timeout=60)
+    log.info("Deleted {0} expired requests".format(db.DeleteOldRequests()))
+    schedule_claims()
+    notifier.Start()
+    expiryScheduler.Start()
+    matchingEngine.Start()
+    masterChat.Start()
+    dispatcher.Start()
+    if webhookConfig:
+        server = WebhookServer(
+            bot,
+            webhookConfig.get("listen", "0.0.0.0"),
+            webhookConfig.get("port", 8443),
+            urlparse(webhookConfig["url"]).path or "/",
+            webhookConfig.get("secret_token"),
+        )
+        bot.set_webhook(
+            url=webhookConfig["url"], secret_token=webhookConfig["secret_token"], allowed_updates=allowedUpdates
+        )
+        server.Serve()
+        dispatcher.Stop()
+    else:
+        bot.remove_webhook()
+        bot.polling(none_stop=True, timeout=60, allowed_updates=allowedUpdates)
@@ -0,0 +1,87 @@
+import logging
+import threading
+import time
+
+import telebot
+
+import database
+
+log = logging.getLogger('bot')
+
+
+class MasterChatAdmins:
+    RefreshInterval = 10 * 60
+
+    def __init__(self, bot: telebot.TeleBot, db: database.DB):
+        self.__bot = bot
+        self.__db = db
+        self.__lock = threading.Lock()
+        self.__refreshEvent = threading.Event()
+        self.__masterChatId = db.GetMasterChatId()
+        self.__admins = None
+        self.__updatedAt = 0.0
+        self.__version = 0
+
+    def Start(self):
+        threading.Thread(target=self.__Run, name="chat-admins", daemon=True).start()
+
+    @property
+    def masterChatId(self):
+        return self.__masterChatId
+
+    def SetMasterChatId(self, chatId, admins: set):
+        self.__db.SetMasterChatId(chatId)
+        with self.__lock:
+            self.__masterChatId = chatId
+            self.__admins = admins
+            self.__updatedAt = time.monotonic()
+            self.__version += 1
+
+    def GetAdmins(self):
+        # stale lists are served while a refresh runs in the background; only a cold cache blocks
+        with self.__lock:
+            admins = self.__admins
+            isStale = time.monotonic() - self.__updatedAt > self.RefreshInterval
+        if self.__masterChatId == 0:
+            return set()
+        if admins is None:
+            return self.__Refresh()
+        if isStale:
+            self.__refreshEvent.set()
+        return admins
+
+    def Invalidate(self):
+        # a demoted admin must lose access at once, so the old set is dropped instead of served while stale
+        with self.__lock:
+            self.__admins = None
+            self.__updatedAt = 0.0
+            self.__version += 1
+        self.__refreshEvent.set()
+
+    def FetchAdmins(self, chatId):
+        return {member.user.username for member in self.__bot.get_chat_administrators(chatId) if member.user.username}
+
+    def __Refresh(self):
+        chatId = self.__masterChatId
+        if chatId == 0:
+            return set()
+        with self.__lock:
+            version = self.__version
+        try:
+            admins = self.FetchAdmins(chatId)
+        except Exception as ex:
+            log.info("Exception during fetching master chat administrators: " + str(ex))
+            with self.__lock:
+                return self.__admins if self.__admins is not None else set()
+        with self.__lock:
+            # a list fetched before an Invalidate may still contain the demoted admin
+            if chatId == self.__masterChatId and version == self.__version:
+                self.__admins = admins
+                self.__updatedAt = time.monotonic()
+        return admins
+
+    def __Run(self):
+        while True:
+            self.__refreshEvent.wait(self.RefreshInterval)
+            self.__refreshEvent.clear()
+            self.__Refresh()
@@ -1,477 +1,1173 @@
+import itertools
+import re
 import sqlite3
 import threading
-from datetime import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
 from enum import IntEnum
-from functools import wraps
 
 import config
 import localizationdic as ld
 
 DBFileName = "database/db.sqlite"
+# dates are stored as ISO text so that they sort and compare correctly inside SQLite
+DateFormat = "%Y-%m-%d %H:%M:%S"
+DisplayDateFormat = "%d.%m.%Y"
+# quantities are stored as integers in millionths, so sums and range scans stay exact and indexed
+QuantityScale = 10 ** 6
+# scaled by QuantityScale it stays well inside SQLite's 64-bit INTEGER
+MaxQuantity = 10 ** 12
+# a page shows several cards in one message of at most 4096 characters, so the only free-form field is bounded
+MaxBankNameLength = 300
+_QuantityUnits = {
+    None: 1,
+    "k": 10 ** 3,
+    "к": 10 ** 3,
+    "тыс": 10 ** 3,
+    "тысяча": 10 ** 3,
+    "тысячи": 10 ** 3,
+    "тысяч": 10 ** 3,
+    "thousand": 10 ** 3,
+    "m": 10 ** 6,
+    "м": 10 ** 6,
+    "mln": 10 ** 6,
+    "млн": 10 ** 6,
+    "million": 10 ** 6,
+    "миллион": 10 ** 6,
+    "миллиона": 10 ** 6,
+    "миллионов": 10 ** 6,
+}
+# longest units first so "тысяч" is not cut to "тыс"; a unit has to end its word, "100 monero" has none
+_QuantityRegex = re.compile(
+    r"([0-9]+(?:[.,][0-9]+)*)\s*(?:({0})(?![a-zа-яё]))?".format(
+        "|".join(sorted((unit for unit in _QuantityUnits if unit), key=len, reverse=True))
+    )
+)
+_DigitGroupRegex = re.compile(r"(?<=[0-9])\s+(?=[0-9])")
+_NumberMarkRegex = re.compile(r"([.,])")
 
-lock = threading.RLock()
 
+class RequestType(IntEnum):
+    Buy = 0
+    Sell = 1
 
-def db_lock(func):
-    @wraps(func)
-    def wrapper(self, *args, **kwargs):
-        with lock:
-            return func(self, *args, **kwargs)
 
-    return wrapper
+class FeeFilter(IntEnum):
+    Any = 0
+    Nobody = 1
+    Seller = 2
+    Buyer = 3
 
 
-class RequestType(IntEnum):
-    Buy = 0
-    Sell = 1
+# data that can be moved with DB.ExportTable/ImportTable: name -> (table, columns in file order)
+ExportTables = {
+    "requests": (
+        "requests",
+        ("id", "username", "requestType", "quantity", "currency", "bankName", "fee", "startDate", "endDate"),
+    ),
+    "users": ("users", ("username", "chatId", "userId")),
+    "votes": ("users_votes", ("username", "votedUser")),
+    "notifications": ("notifications", ("username", "chatId")),
+    "blacklist": ("users_blacklist", ("userId",)),
+    "languages": ("users_languages", ("username", "language")),
+}
+
+
+def _has_column(cur, table, column):
+    cur.execute("PRAGMA table_info('{0}')".format(table))
+    return any(r[1] == column for r in cur.fetchall())
+
+
+def _migrate_baseline(cur):
+    cur.execute(
+        """CREATE TABLE IF NOT EXISTS requests (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT,
+            requestType INTEGER, quantity INTEGER, currency TEXT, bankName TEXT, fee REAL,
+            startDate TEXT, endDate TEXT)"""
+    )
+    cur.execute("CREATE TABLE IF NOT EXISTS notifications (username TEXT, chatId INTEGER)")
+    cur.execute("CREATE TABLE IF NOT EXISTS masterchat (chatId INTEGER)")
+    cur.execute("CREATE TABLE IF NOT EXISTS users (username TEXT)")
+    cur.execute("CREATE TABLE IF NOT EXISTS users_votes (username TEXT, votedUser TEXT)")
+    cur.execute("CREATE TABLE IF NOT EXISTS users_languages (username TEXT, language INTEGER)")
+    cur.execute("CREATE TABLE IF NOT EXISTS users_blacklist (userId INTEGER, UNIQUE(userId))")
+    cur.execute("CREATE TABLE IF NOT EXISTS additional_assets (assetName TEXT)")
+    cur.execute("CREATE TABLE IF NOT EXISTS processing_requests (reqId INTEGER, seller TEXT, buyer TEXT)")
+    # databases created before versioning may already have these columns
+    if not _has_column(cur, "users", "chatId"):
+        cur.execute("ALTER TABLE users ADD COLUMN chatId INTEGER")
+    if not _has_column(cur, "users", "userId"):
+        cur.execute("ALTER TABLE users ADD COLUMN userId INTEGER DEFAULT 0")
+
+
+def _migrate_indexes(cur):
+    # drop orphans and duplicates left by the unconstrained schema before adding UNIQUE indexes
+    sqls = [
+        "DELETE FROM requests WHERE username NOT IN (SELECT username FROM users)",
+        "DELETE FROM notifications WHERE username NOT IN (SELECT username FROM users)",
+        "DELETE FROM users_votes WHERE username NOT IN (SELECT username FROM users)",
+        "DELETE FROM users_votes WHERE votedUser NOT IN (SELECT username FROM users)",
+        "DELETE FROM users_languages WHERE username NOT IN (SELECT username FROM users)",
+        "DELETE FROM users WHERE rowid NOT IN (SELECT max(rowid) FROM users GROUP BY username)",
+        "DELETE FROM notifications WHERE rowid NOT IN (SELECT max(rowid) FROM notifications GROUP BY username)",
+        "DELETE FROM users_votes WHERE rowid NOT IN "
+        "(SELECT min(rowid) FROM users_votes GROUP BY username, votedUser)",
+        "DELETE FROM users_languages WHERE rowid NOT IN " "(SELECT max(rowid) FROM users_languages GROUP BY username)",
+        "DELETE FROM processing_requests WHERE rowid NOT IN "
+        "(SELECT min(rowid) FROM processing_requests GROUP BY reqId)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS users_username ON users(username)",
+        "CREATE INDEX IF NOT EXISTS users_userId ON users(userId)",
+        "CREATE INDEX IF NOT EXISTS requests_username ON requests(username)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS users_votes_username_votedUser ON users_votes(username, votedUser)",
+        "CREATE INDEX IF NOT EXISTS users_votes_votedUser ON users_votes(votedUser)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS notifications_username ON notifications(username)",
+        "CREATE INDEX IF NOT EXISTS notifications_chatId ON notifications(chatId)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS users_languages_username ON users_languages(username)",
+        "CREATE UNIQUE INDEX IF NOT EXISTS processing_requests_reqId ON processing_requests(reqId)",
+    ]
+    for sql in sqls:
+        cur.execute(sql)
+
+
+def _migrate_iso_dates(cur):
+    for column in ("startDate", "endDate"):
+        cur.execute(
+            "UPDATE requests SET {0} = substr({0}, 7, 4) || '-' || substr({0}, 4, 2) || '-' || substr({0}, 1, 2) "
+            "|| ' 00:00:00' WHERE {0} GLOB '[0-9][0-9].[0-9][0-9].[0-9][0-9][0-9][0-9]'".format(column)
+        )
+    cur.execute("CREATE INDEX IF NOT EXISTS requests_endDate ON requests(endDate)")
+
+
+def _migrate_sessions(cur):
+    cur.execute(
+        "CREATE TABLE IF NOT EXISTS sessions (username TEXT PRIMARY KEY, chatId INTEGER, state TEXT, updatedAt TEXT)"
+    )
+
+
+def _migrate_search_indexes(cur):
+    # each search is a range scan over one of these; fee and quantity are part of the key so filters
+    # are checked without touching the table and only the rows of the requested page are read
+    cur.execute("CREATE INDEX IF NOT EXISTS requests_search_fee ON requests(currency, requestType, fee, id, quantity)")
+    cur.execute("CREATE INDEX IF NOT EXISTS requests_search_recent ON requests(currency, requestType, id, quantity)")
+
+
+def _migrate_fixed_point_quantity(cur):
+    # stored text follows the same separator rules as new input; SQLite already turned plain numbers into numbers.
+    # Text that is no number becomes 0 as before, amounts over MaxQuantity are capped
+    cur.execute("SELECT id, quantity FROM requests")
+    updates = []
+    for reqId, quantity in cur.fetchall():
+        try:
+            if isinstance(quantity, (int, float)):
+                value = Decimal(str(quantity))
+            else:
+                value = _parse_number(str(quantity).strip())
+        except (ValueError, InvalidOperation):
+            value = Decimal(0)
+        updates.append((min(_to_fixed_point(value), MaxQuantity * QuantityScale), reqId))
+    cur.executemany("UPDATE requests SET quantity=? WHERE id=?", updates)
+
+
+def _migrate_escrow_scores(cur):
+    cur.execute("CREATE TABLE IF NOT EXISTS escrow_scores (username TEXT PRIMARY KEY, votes INTEGER NOT NULL)")
+    cur.execute("CREATE INDEX IF NOT EXISTS escrow_scores_votes ON escrow_scores(votes, username)")
+    _rebuild_escrow_scores(cur)
+
+
+def _rebuild_escrow_scores(cur):
+    cur.execute("DELETE FROM escrow_scores")
+    cur.execute(
+        "INSERT INTO escrow_scores(username, votes) SELECT votedUser, count(*) FROM users_votes GROUP BY votedUser"
+    )
+
+
+def _migrate_claims(cur):
+    if not _has_column(cur, "processing_requests", "expiresAt"):
+        cur.execute("ALTER TABLE processing_requests ADD COLUMN expiresAt TEXT")
+    if not _has_column(cur, "processing_requests", "claimant"):
+        cur.execute("ALTER TABLE processing_requests ADD COLUMN claimant TEXT")
+    # claims made before expiry was persisted lost their timers on restart and would block the request forever
+    cur.execute("DELETE FROM processing_requests WHERE expiresAt IS NULL")
+    cur.execute("CREATE INDEX IF NOT EXISTS processing_requests_expiresAt ON processing_requests(expiresAt)")
+
+
+# schema version N is reached by applying Migrations[:N]; only append to this list
+Migrations = [
+    _migrate_baseline,
+    _migrate_indexes,
+    _migrate_iso_dates,
+    _migrate_sessions,
+    _migrate_search_indexes,
+    _migrate_fixed_point_quantity,
+    _migrate_escrow_scores,
+    _migrate_claims,
+]
+
+
+def parse_date(value: str) -> datetime:
+    return datetime.strptime(value, DateFormat)
+
+
+def _parse_number(number: str) -> Decimal:
+    # "," and "." are both decimal marks and thousands separators. The last mark is decimal when the other marks
+    # differ from it ("1.000,5") or its group is not three digits ("1,5"). A single mark before three digits groups
+    # thousands ("1,000"), unless the integer part is 0 or longer than a group ("0,125", "1000,500")
+    parts = _NumberMarkRegex.split(number)
+    groups, marks = parts[0::2], parts[1::2]
+    decimalMark, fraction = None, "0"
+    if len(marks) > 0 and (
+        len(groups[-1]) != 3 or len(set(marks)) > 1 or (len(marks) == 1 and (groups[0] == "0" or len(groups[0]) > 3))
+    ):
+        decimalMark, fraction = marks[-1], groups[-1]
+        groups, marks = groups[:-1], marks[:-1]
+    if len(marks) > 0 and (
+        len(groups[0]) > 3 or len(set(marks)) > 1 or decimalMark in marks or any(len(g) != 3 for g in groups[1:])
+    ):
+        raise ValueError("Wrong number: " + number)
+    return Decimal("".join(groups) + "." + fraction)
+
+
+def _to_fixed_point(value: Decimal) -> int:
+    return int((value * QuantityScale).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def parse_quantity(text: str) -> int:
+    # "1500", "1 500 BTS", "1,000", "1.000.000", "1,5k BTS", "2 млн руб", "3m usd", "5 тысяч" -> fixed-point integer
+    # in QuantityScale units
+    match = _QuantityRegex.search(_DigitGroupRegex.sub("", text.lower()))
+    if match is None:
+        raise ValueError("Wrong quantity: " + text)
+    value = _to_fixed_point(_parse_number(match.group(1)) * _QuantityUnits[match.group(2)])
+    if value <= 0 or value > MaxQuantity * QuantityScale:
+        raise ValueError("Wrong quantity: " + text)
+    return value
+
+
+def format_quantity(value: int) -> str:
+    return "{0:f}".format((Decimal(value) / QuantityScale).normalize())
+
+
+class Request:
+    # a requests row with its columns parsed once, so handlers and the renderer never index or re-parse rows
+    __slots__ = ("id", "username", "reqType", "quantity", "currency", "bankName", "fee", "startDate", "endDate")
+
+    def __init__(
+        self,
+        reqId: int,
+        username: str,
+        reqType: RequestType,
+        quantity: int,
+        currency: str,
+        bankName: str,
+        fee: float,
+        startDate: datetime,
+        endDate: datetime,
+    ):
+        self.id = reqId
+        self.username = username
+        self.reqType = reqType
+        self.quantity = quantity
+        self.currency = currency
+        self.bankName = bankName
+        self.fee = fee
+        self.startDate = startDate
+        self.endDate = endDate
+
+    @classmethod
+    def FromRow(cls, row):
+        return cls(
+            row[0],
+            row[1],
+            RequestType(row[2]),
+            int(row[3]),
+            row[4],
+            row[5],
+            float(str(row[6]).replace(",", ".")),
+            parse_date(row[7]),
+            parse_date(row[8]),
+        )
+
+    def __eq__(self, other):
+        if not isinstance(other, Request):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    __hash__ = None
+
+
+class ProcessingRequest:
+    # an accepted request waiting for its owner's confirmation
+    __slots__ = ("reqId", "seller", "buyer", "expiresAt", "claimant")
+
+    def __init__(self, reqId: int, seller: str, buyer: str, expiresAt: datetime, claimant: str):
+        self.reqId = reqId
+        self.seller = seller
+        self.buyer = buyer
+        self.expiresAt = expiresAt
+        self.claimant = claimant
+
+    @classmethod
+    def FromRow(cls, row):
+        return cls(row[0], row[1], row[2], parse_date(row[3]), row[4])
+
+
+class Queries:
+    GetAssets = "SELECT * FROM assets"
+    GetAdditionalAssets = "SELECT * FROM additional_assets"
+
+    CountNotifications = "SELECT count(*) FROM notifications"
+    CountNotificationsForUser = "SELECT count(*) FROM notifications WHERE username=?"
+    AddNotifications = "INSERT OR IGNORE INTO notifications(username, chatId) VALUES(?, ?)"
+    DeleteNotificationsForUser = "DELETE FROM notifications WHERE username=?"
+    DeleteNotificationsForChat = "DELETE FROM notifications WHERE chatId=?"
+    GetNotificationChats = "SELECT chatId FROM notifications WHERE username != ?"
+
+    AddRequest = (
+        "INSERT INTO requests(username, requestType, quantity, currency, bankName, fee, startDate, endDate) "
+        "VALUES(?, ?, ?, ?, ?, ?, ?, ?)"
+    )
+    UpdateRequest = (
+        "UPDATE requests SET fee=?, quantity=?, currency=?, bankName=?, startDate=?, endDate=? "
+        "WHERE id=? AND username=?"
+    )
+    GetRequest = "SELECT * FROM requests WHERE id=?"
+    GetRequestOwner = "SELECT username FROM requests WHERE id=?"
+    GetRequestsForUser = "SELECT * FROM requests WHERE username=?"
+    GetRequestsPage = "SELECT * FROM requests LIMIT ?, ?"
+    GetRequestsNewestFirst = "SELECT * FROM requests ORDER BY id DESC LIMIT ?"
+    GetRequestsBefore = "SELECT * FROM requests WHERE id < ? ORDER BY id DESC LIMIT ?"
+    GetRequestsAfter = "SELECT * FROM requests WHERE id > ? ORDER BY id ASC LIMIT ?"
+    GetRequestsEndDates = "SELECT id, endDate FROM requests"
+    GetAllRequests = "SELECT * FROM requests"
+    GetOpenVolume = (
+        "SELECT currency, requestType, count(*), sum(quantity) FROM requests GROUP BY currency, requestType "
+        "ORDER BY currency, requestType"
+    )
+    GetRequestsEndedBy = "SELECT * FROM requests WHERE endDate <= ? ORDER BY endDate LIMIT ?"
+    GetRequestIdsForUser = "SELECT id FROM requests WHERE username=?"
+    GetRequestsEndingBetween = "SELECT * FROM requests WHERE endDate >= ? AND endDate < ? ORDER BY endDate"
+    SearchRequests = "SELECT * FROM requests WHERE {0} ORDER BY {1} LIMIT ?"
+    CountRequests = "SELECT count(*) FROM requests"
+    DeleteRequest = "DELETE FROM requests WHERE id=?"
+    DeleteRequestsForUser = "DELETE FROM requests WHERE username=?"
+
+    GetMasterChat = "SELECT chatId FROM masterchat"
+    AddMasterChat = "INSERT INTO masterchat(chatId) VALUES(?)"
+
+    CountUsers = "SELECT count(*) FROM users"
+    CountUsersWithName = "SELECT count(*) FROM users WHERE username=?"
+    AddUser = "INSERT OR IGNORE INTO users(username) VALUES(?)"
+    DeleteUser = "DELETE FROM users WHERE username=?"
+    UpdateUser = "UPDATE OR REPLACE users SET userId=?, username=? WHERE username=? OR userId=?"
+    UpdateUserChatId = "UPDATE users SET chatId=? WHERE username=?"
+    GetUserChatId = "SELECT chatId FROM users WHERE username=?"
+    GetUserIds = "SELECT chatId, userId FROM users WHERE username=?"
+    GetUserId = "SELECT userId FROM users WHERE username=?"
+
+    AddToBlacklist = "INSERT OR IGNORE INTO users_blacklist(userId) VALUES(?)"
+    CountBlacklistedUserId = "SELECT count(*) FROM users_blacklist WHERE userId=?"
+
+    CountVotesByUser = "SELECT count(*) FROM users_votes WHERE username=?"
+    CountVote = "SELECT count(*) FROM users_votes WHERE username=? AND votedUser=?"
+    AddVote = "INSERT OR IGNORE INTO users_votes(username, votedUser) VALUES(?, ?)"
+    DeleteVote = "DELETE FROM users_votes WHERE username=? AND votedUser=?"
+    DeleteVotesByUser = "DELETE FROM users_votes WHERE username=?"
+    DeleteVotesForUser = "DELETE FROM users_votes WHERE votedUser=?"
+    GetVotedUsers = "SELECT votedUser FROM users_votes WHERE username=?"
+
+    IncrementEscrowScore = "UPDATE escrow_scores SET votes = votes + 1 WHERE username=?"
+    AddEscrowScore = "INSERT INTO escrow_scores(username, votes) VALUES(?, 1)"
+    DecrementEscrowScore = "UPDATE escrow_scores SET votes = votes - 1 WHERE username=?"
+    DecrementEscrowScoresByVoter = (
+        "UPDATE escrow_scores SET votes = votes - 1 "
+        "WHERE username IN (SELECT votedUser FROM users_votes WHERE username=?)"
+    )
+    DeleteEscrowScore = "DELETE FROM escrow_scores WHERE username=?"
+    DeleteEmptyEscrowScores = "DELETE FROM escrow_scores WHERE votes <= 0"
+    GetTopEscrowScores = "SELECT username, votes FROM escrow_scores ORDER BY votes DESC, username DESC LIMIT ?"
+
+    GetUserLanguage = "SELECT language FROM users_languages WHERE username=?"
+    AddUserLanguage = "INSERT OR IGNORE INTO users_languages(username, language) VALUES(?, ?)"
+    UpdateUserLanguage = "UPDATE users_languages SET language=? WHERE username=?"
+    DeleteUserLanguage = "DELETE FROM users_languages WHERE username=?"
+
+    SaveSession = "INSERT OR REPLACE INTO sessions(username, chatId, state, updatedAt) VALUES(?, ?, ?, ?)"
+    GetSession = "SELECT chatId, state FROM sessions WHERE username=?"
+    DeleteSession = "DELETE FROM sessions WHERE username=?"
+
+    AddProcessingRequest = (
+        "INSERT OR FAIL INTO processing_requests(reqId, seller, buyer, expiresAt, claimant) VALUES(?, ?, ?, ?, ?)"
+    )
+    GetProcessingRequest = (
+        "SELECT reqId, seller, buyer, expiresAt, claimant FROM processing_requests WHERE reqId=? AND expiresAt > ?"
+    )
+    GetProcessingRequestsExpiry = "SELECT reqId, expiresAt FROM processing_requests"
+    GetExpiredProcessingRequestClaimant = "SELECT claimant FROM processing_requests WHERE reqId=? AND expiresAt <= ?"
+    DeleteActiveProcessingRequest = "DELETE FROM processing_requests WHERE reqId=? AND expiresAt > ?"
+    DeleteExpiredProcessingRequest = "DELETE FROM processing_requests WHERE reqId=? AND expiresAt <= ?"
+
+    # formatted with the table and columns of one of ExportTables
+    ExportTable = "SELECT {1} FROM {0}"
+    ImportTable = "INSERT OR REPLACE INTO {0}({1}) VALUES({2})"
+
+    @classmethod
+    def Count(cls):
+        return sum(1 for name, value in vars(cls).items() if isinstance(value, str) and not name.startswith("_"))
+
+
+class LanguageCache:
+    # every Set/Invalidate bumps version; a value read from the DB on a miss is only added by AddIfUnchanged
+    # when no change happened meanwhile, so a concurrent SetUserLanguage is never overwritten by a stale read
+    def __init__(self, maxSize: int):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self.version = 0
+        self.__items = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def Get(self, username):
+        with self.__lock:
+            language = self.__items.get(username)
+            if language is None:
+                self.misses += 1
+                return None
+            self.__items.move_to_end(username)
+            self.hits += 1
+            return language
+
+    def Set(self, username, language):
+        with self.__lock:
+            self.version += 1
+            self.__Put(username, language)
+
+    def AddIfUnchanged(self, username, language, version: int):
+        with self.__lock:
+            if version == self.version and username not in self.__items:
+                self.__Put(username, language)
+
+    def Invalidate(self, username):
+        with self.__lock:
+            self.version += 1
+            self.__items.pop(username, None)
+
+    def __Put(self, username, language):
+        self.__items[username] = language
+        self.__items.move_to_end(username)
+        while len(self.__items) > self.maxSize:
+            self.__items.popitem(last=False)
+
+    def __len__(self):
+        return len(self.__items)
+
+
+class RequestRenderer:
+    # each language's card template and words are looked up once; rendered cards are cached per (reqId, language)
+    # together with the row they were made from, so the row itself acts as the version and a changed request
+    # is never served stale even if it is read concurrently with an update
+    def __init__(self, maxSize: int):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self.__languages = [self.__Compile(language) for language in ld.Languages]
+        self.__items = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def Render(self, req: Request, language: int):
+        key = (req.id, language)
+        with self.__lock:
+            item = self.__items.get(key)
+            if item is not None and item[0] == req:
+                self.__items.move_to_end(key)
+                self.hits += 1
+                return item[1]
+            self.misses += 1
+        text = self.__Format(req, language)
+        with self.__lock:
+            self.__items[key] = (req, text)
+            self.__items.move_to_end(key)
+            while len(self.__items) > self.maxSize:
+                self.__items.popitem(last=False)
+        return text
+
+    def OnRequestSaved(self, req: Request):
+        self.__Invalidate([req.id])
+
+    def OnRequestsDeleted(self, reqIds: list):
+        self.__Invalidate(reqIds)
+
+    def __len__(self):
+        return len(self.__items)
+
+    def __Invalidate(self, reqIds):
+        with self.__lock:
+            for reqId in reqIds:
+                for language in ld.Languages:
+                    self.__items.pop((reqId, int(language)), None)
+
+    @staticmethod
+    def __Compile(language):
+        strings = ld.get_language_strings(language)
+        return (
+            strings[ld.RequestResultStringTemplate].format,
+            {RequestType.Buy: strings[ld.BuyKey].lower(), RequestType.Sell: strings[ld.SellKey].lower()},
+            strings[ld.FeePayBuyerKey],
+            strings[ld.FeePaySellerKey],
+        )
+
+    def __Format(self, req: Request, language: int):
+        template, reqTypes, feePayBuyer, feePaySeller = self.__languages[language]
+        whoPayFee = ""
+        if req.fee > 0:
+            whoPayFee = feePayBuyer
+        elif req.fee < 0:
+            whoPayFee = feePaySeller
+        return template(
+            req.id,
+            req.username,
+            reqTypes[req.reqType],
+            format_quantity(req.quantity),
+            req.currency,
+            req.fee,
+            whoPayFee,
+            # rows saved before the limit existed are cut when shown
+            req.bankName if len(req.bankName) <= MaxBankNameLength else req.bankName[: MaxBankNameLength - 1] + "…",
+            req.startDate.strftime(DisplayDateFormat),
+            req.endDate.strftime(DisplayDateFormat),
+        )
 
 
 class DB:
 
     MaxVotes = 5
     EscrowListTemplate = "@{0} - <b>{1}</b>"
+    LanguageCacheSize = 10000
+    RenderCacheSize = 20000
+    BusyTimeout = 30.0
+    ExpiryBatchSize = 500
+    EscrowListSize = 100
+    ImportBatchSize = 100000
+    # FULL makes every commit durable at the cost of one fsync each. Under WAL, NORMAL skips that fsync: a power
+    # loss can drop the last commits but never corrupts the database, so it is only used when config asks for it
+    Synchronous = getattr(config, "db_synchronous", "FULL")
+    # every registered query, every shape SearchRequests can build (168 combinations of filters, sort and cursor)
+    # and the schema and maintenance statements, so no hot statement is ever evicted and re-prepared
+    SearchStatements = 168
+    CachedStatements = Queries.Count() + SearchStatements + 32
 
     def __init__(self):
-        self.conn = sqlite3.connect(DBFileName, check_same_thread=False)
-        self.cur = self.conn.cursor()
-        sql = """CREATE TABLE IF NOT EXISTS requests (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT,
-                    requestType INTEGER, quantity INTEGER, currency TEXT, bankName TEXT, fee REAL,
-                    startDate TEXT, endDate TEXT);
-                 CREATE TABLE IF NOT EXISTS notifications (username TEXT, chatId INTEGER);
-                 CREATE TABLE IF NOT EXISTS masterchat (chatId INTEGER);
-                 CREATE TABLE IF NOT EXISTS users (username TEXT);
-                 CREATE TABLE IF NOT EXISTS users_votes (username TEXT, votedUser TEXT);
-                 CREATE TABLE IF NOT EXISTS users_languages (username TEXT, language INTEGER);
-                 DROP TABLE IF EXISTS assets;
-                 CREATE TABLE IF NOT EXISTS assets (assetName TEXT);
-                 CREATE TABLE IF NOT EXISTS additional_assets (assetName TEXT);
-                 CREATE TABLE IF NOT EXISTS processing_requests (reqId INTEGER, seller TEXT, buyer TEXT);"""
-        self.cur.executescript(sql)
+        self.languageCache = LanguageCache(self.LanguageCacheSize)
+        self.requestRenderer = RequestRenderer(self.RenderCacheSize)
+        self.__local = threading.local()
+        self.__requestsListeners = [self.requestRenderer]
+        self.__countLock = threading.Lock()
+        self.__escrowLock = threading.Lock()
+        self.__escrowList = None
+        self.__escrowVersion = 0
+        self.cur.execute("PRAGMA journal_mode=WAL").fetchone()
+        self.__Migrate()
         self.__FillAssetsTable()
-        self.__AddChatIdColumnToUsersTable()
-        self.__BlacklistMigration()
-        self.__cleanup_db()
+        self.cur.execute(Queries.CountRequests)
+        self.__requestsCount = int(self.cur.fetchone()[0])
+
+    def AddRequestsListener(self, listener):
+        # listener gets OnRequestSaved(req) after AddRequest/UpdateRequest and OnRequestsDeleted(reqIds)
+        self.__requestsListeners.append(listener)
+
+    @contextmanager
+    def Transaction(self):
+        # unit of work: DB methods called inside share one transaction of this thread's connection, which is
+        # committed when the outermost unit ends or rolled back when it raises
+        local = self.__Connect()
+        local.depth += 1
+        try:
+            yield self
+        except BaseException:
+            local.depth -= 1
+            if local.depth == 0:
+                local.afterCommit = []
+                local.conn.rollback()
+            raise
+        local.depth -= 1
+        self.__Commit()
+
+    @property
+    def conn(self):
+        return self.__Connect().conn
+
+    @property
+    def cur(self):
+        return self.__Connect().cur
+
+    def __Connect(self):
+        local = self.__local
+        if not hasattr(local, "conn"):
+            # every thread gets its own connection: WAL lets readers run concurrently,
+            # while writers are serialized by SQLite and wait up to BusyTimeout for the lock
+            local.conn = sqlite3.connect(DBFileName, timeout=self.BusyTimeout, cached_statements=self.CachedStatements)
+            local.conn.execute("PRAGMA synchronous={0}".format(self.Synchronous))
+            local.cur = local.conn.cursor()
+            local.depth = 0
+            local.afterCommit = []
+        return local
 
-    @db_lock
     def GetAssetsList(self):
-        sql = "SELECT * FROM assets"
-        self.cur.execute(sql)
+        self.cur.execute(Queries.GetAssets)
         rows = self.cur.fetchall()
         assetsList = [r[0] for r in rows]
 
-        sql = "SELECT * FROM additional_assets"
-        self.cur.execute(sql)
+        self.cur.execute(Queries.GetAdditionalAssets)
         rows = self.cur.fetchall()
         addAssetsList = [r[0] for r in rows]
 
         assetsList.extend(addAssetsList)
         return assetsList
 
-    @db_lock
     def IsNotificationsRowExistForUser(self, username):
-        sql = "SELECT count(*) FROM notifications WHERE username=\"{}\"".format(username)
-        self.cur.execute(sql)
+        self.cur.execute(Queries.CountNotificationsForUser, (username,))
         count = self.cur.fetchone()
         return count[0] > 0
 
-    @db_lock
     def AddUserForNotifications(self, username, chatId):
-        sql = "INSERT INTO notifications(username, chatId) VALUES(\"{0}\",\"{1}\")".format(username, chatId)
-        self.cur.execute(sql)
-        self.conn.commit()
+        self.cur.execute(Queries.AddNotifications, (username, chatId))
+        self.__Commit()
 
-    @db_lock
     def DeleteUserFromNotifications(self, username):
-        sql = "DELETE FROM notifications WHERE username=\"{0}\"".format(username)
-        self.cur.execute(sql)
-        self.conn.commit()
+        self.cur.execute(Queries.DeleteNotificationsForUser, (username,))
+        self.__Commit()
+
+    def DeleteUserFromNotificationsByChatId(self, chatId):
+        self.cur.execute(Queries.DeleteNotificationsForChat, (chatId,))
+        self.__Commit()
 
-    @db_lock
     def GetUserlistForNotifications(self, excludeUser):
-        sql = "SELECT chatId FROM notifications WHERE username != \"{0}\"".format(excludeUser)
-        self.cur.execute(sql)
+        self.cur.execute(Queries.GetNotificationChats, (excludeUser,))
         rows = self.cur.fetchall()
         return [r[0] for r in rows]
 
-    @db_lock
     def AddRequest(
         self, username, reqType: RequestType, quantity, currency, bankName, fee, startDate: datetime, endDate: datetime
     ):
-        sql = (
-            "INSERT INTO requests(username, requestType, quantity, currency, bankName, fee, startDate, endDate) "
-            "VALUES(\"{0}\",\"{1}\",\"{2}\",\"{3}\",\"{4}\",\"{5}\",\"{6}\",\"{7}\")".format(
+        self.cur.execute(
+            Queries.AddRequest,
+            (
                 username,
                 int(reqType),
                 quantity,
                 currency,
                 bankName,
                 fee,
-                startDate.strftime("%d.%m.%Y"),
-                endDate.strftime("%d.%m.%Y"),
-            )
+                startDate.strftime(DateFormat),
+                endDate.strftime(DateFormat),
+            ),
         )
-        self.cur.execute(sql)
-        self.conn.commit()
-        sql = "SELECT last_insert_rowid() FROM requests"
-        self.cur.execute(sql)
-        rowId = self.cur.fetchone()
-        return int(rowId[0])
-
-    @db_lock
+        self.__Commit()
+        reqId = int(self.cur.lastrowid)
+        self.__UpdateRequestsCount(1)
+        self.__OnRequestSaved(reqId)
+        return reqId
+
     def GetRequest(self, reqId, callUser):
-        sql = "SELECT * FROM requests WHERE id=" + str(reqId)
-        results = self.__getResultsForSql(sql, callUser)
-        if len(results) > 0:
-            return results[0]
+        cards = self.__getCardsForSql(callUser, Queries.GetRequest, (reqId,))
+        if len(cards) > 0:
+            return cards[0][1]
         return None
 
-    @db_lock
     def GetRawRequest(self, reqId):
-        sql = "SELECT * FROM requests WHERE id=" + str(reqId)
-        self.cur.execute(sql)
+        self.cur.execute(Queries.GetRequest, (reqId,))
         rows = self.cur.fetchall()
-        return tuple(rows[0])
+        return Request.FromRow(rows[0])
 
-    @db_lock
-    def GetRequestsFor(self, username, callUser):
-        sql = "SELECT * FROM requests WHERE username = \"{0}\"".format(username)
-        results = self.__getResultsForSql(sql, callUser)
-        return results
+    def GetRequestCardsFor(self, username, callUser):
+        # [(Request, rendered text)]
+        return self.__getCardsForSql(callUser, Queries.GetRequestsForUser, (username,))
 
-    @db_lock
     def GetAllRequestsCount(self):
-        sql = "SELECT count(*) FROM requests"
-        self.cur.execute(sql)
-        row = self.cur.fetchone()
-        return int(row[0])
+        with self.__countLock:
+            return self.__requestsCount
+
+    def GetAllRequests(self, callUser, beforeId: int, limit: int):
+        # newest first, starting right below beforeId or from the newest request when beforeId is 0
+        if beforeId > 0:
+            self.cur.execute(Queries.GetRequestsBefore, (beforeId, limit))
+        else:
+            self.cur.execute(Queries.GetRequestsNewestFirst, (limit,))
+        return [Request.FromRow(r) for r in self.cur.fetchall()]
 
-    @db_lock
-    def GetAllRequests(self, callUser, offset: int, limit: int):
-        sql = "SELECT * FROM requests ORDER BY id DESC LIMIT {0}, {1}".format(offset, limit)
-        self.cur.execute(sql)
+    def GetAllRequestsAfter(self, callUser, afterId: int, limit: int):
+        # the page right above afterId, still ordered newest first
+        self.cur.execute(Queries.GetRequestsAfter, (afterId, limit))
         rows = self.cur.fetchall()
-        return [tuple(r) for r in rows]
+        return [Request.FromRow(r) for r in reversed(rows)]
+
+    def SearchRequests(self, search, cursor: tuple, limit: int):
+        # cursor is the sort key of the last row of the previous page: (id,) or (fee, id) when sorted by fee.
+        # Every query is a range scan over one side's index; without a side both sides are read and merged, as
+        # a single query over both would sort all of the currency's rows for every page
+        conditions = ["currency=?", "requestType=?"]
+        params = [search.currency, None]
+        if search.minQuantity is not None:
+            conditions.append("quantity >= ?")
+            params.append(search.minQuantity)
+        if search.maxQuantity is not None:
+            conditions.append("quantity <= ?")
+            params.append(search.maxQuantity)
+        # fee filters under the id order go through +fee so the planner stays on the id-ordered index
+        fee = "fee" if search.sortByFee else "+fee"
+        if search.feeFilter == FeeFilter.Nobody:
+            conditions.append(fee + " = 0")
+        elif search.feeFilter == FeeFilter.Buyer:
+            conditions.append(fee + " > 0")
+        elif search.feeFilter == FeeFilter.Seller:
+            conditions.append(fee + " < 0")
+        if search.maxFee is not None and search.feeFilter != FeeFilter.Nobody:
+            if search.feeFilter != FeeFilter.Seller:
+                conditions.append(fee + " <= ?")
+                params.append(search.maxFee)
+            if search.feeFilter != FeeFilter.Buyer:
+                conditions.append(fee + " >= ?")
+                params.append(-search.maxFee)
+        if search.sortByFee:
+            direction = "ASC" if search.feeAscending else "DESC"
+            if cursor is not None and search.feeFilter == FeeFilter.Nobody:
+                # the fee is fixed, a row value here would leave the id part of the order to a temp b-tree
+                conditions.append("id {0} ?".format(">" if search.feeAscending else "<"))
+                params.append(cursor[1])
+            elif cursor is not None:
+                conditions.append("(fee, id) {0} (?, ?)".format(">" if search.feeAscending else "<"))
+                params.extend(cursor)
+            orderBy = "fee {0}, id {0}".format(direction)
+        else:
+            if cursor is not None:
+                conditions.append("id < ?")
+                params.extend(cursor)
+            orderBy = "id DESC"
+        params.append(limit)
+        sql = Queries.SearchRequests.format(" AND ".join(conditions), orderBy)
+        sides = list(RequestType) if search.requestType is None else [search.requestType]
+        reqs = []
+        for side in sides:
+            params[1] = int(side)
+            self.cur.execute(sql, params)
+            reqs.extend(Request.FromRow(r) for r in self.cur.fetchall())
+        if len(sides) > 1:
+            if search.sortByFee:
+                reqs.sort(key=lambda req: (req.fee, req.id), reverse=not search.feeAscending)
+            else:
+                reqs.sort(key=lambda req: req.id, reverse=True)
+            reqs = reqs[:limit]
+        return reqs
 
-    @db_lock
     def GetAllFormattedRequests(self, callUser, offset: int, limit: int):
-        sql = "SELECT * FROM requests LIMIT {0}, {1}".format(offset, limit)
-        return self.__getResultsForSql(sql, callUser)
+        return [text for req, text in self.__getCardsForSql(callUser, Queries.GetRequestsPage, (offset, limit))]
 
-    @db_lock
     def DeleteReqWithId(self, reqId):
-        sql = "DELETE FROM requests WHERE id={0}".format(reqId)
-        self.cur.execute(sql)
-        self.conn.commit()
+        self.cur.execute(Queries.DeleteRequest, (reqId,))
+        self.__Commit()
+        self.__UpdateRequestsCount(-self.cur.rowcount)
+        self.__OnRequestsDeleted([reqId])
 
-    @db_lock
     def UpdateRequest(
         self, reqId, username, quantity, currency, bankName, fee, startDate: datetime, endDate: datetime = None
     ):
         if (not quantity) and (not currency) and (not bankName) and fee < 0.0 and (not endDate):
             return
-        updateValues = []
-        updateValues.append("fee=" + str(fee))
-        updateValues.append("quantity=\"{}\"".format(quantity))
-        updateValues.append("currency=\"{}\"".format(currency))
-        updateValues.append("bankName=\"{}\"".format(bankName))
-        updateValues.append("startDate=\"{}\"".format(startDate.strftime("%d.%m.%Y")))
-        updateValues.append("endDate=\"{}\"".format(endDate.strftime("%d.%m.%Y")))
-        aggregated = ",".join(updateValues)
-        sql = "UPDATE requests SET " + aggregated + " WHERE id=" + str(reqId) + " AND username=\"" + username + "\""
-        self.cur.execute(sql)
-        self.conn.commit()
-
-    @db_lock
+        self.cur.execute(
+            Queries.UpdateRequest,
+            (
+                fee,
+                quantity,
+                currency,
+                bankName,
+                startDate.strftime(DateFormat),
+                endDate.strftime(DateFormat),
+                reqId,
+                username,
+            ),
+        )
+        self.__Commit()
+        if self.cur.rowcount > 0:
+            self.__OnRequestSaved(reqId)
+
+    def ExportTable(self, name: str):
+        # rows are streamed from a cursor of their own, so neither the table nor other queries are held up
+        table, columns = ExportTables[name]
+        cur = self.conn.cursor()
+        try:
+            yield from cur.execute(Queries.ExportTable.format(table, ", ".join(columns)))
+        finally:
+            cur.close()
+
+    def ImportTable(self, name: str, rows) -> int:
+        # rows are tuples in ExportTables column order and replace existing rows with the same key; every
+        # ImportBatchSize rows go in with one executemany and one commit. Listeners are not notified, so
+        # this is meant for a stopped bot
+        table, columns = ExportTables[name]
+        sql = Queries.ImportTable.format(table, ", ".join(columns), ", ".join("?" * len(columns)))
+        rows = iter(rows)
+        count = 0
+        while True:
+            batch = list(itertools.islice(rows, self.ImportBatchSize))
+            if len(batch) == 0:
+                break
+            try:
+                self.cur.executemany(sql, batch)
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            count += len(batch)
+        if table == "users_votes":
+            _rebuild_escrow_scores(self.cur)
+            self.conn.commit()
+            self.__InvalidateEscrowList()
+        if table == "requests":
+            self.cur.execute(Queries.CountRequests)
+            with self.__countLock:
+                self.__requestsCount = int(self.cur.fetchone()[0])
+        return count
+
     def DeleteOldRequests(self):
-        sql = "SELECT id, endDate FROM requests"
-        self.cur.execute(sql)
-        results = self.cur.fetchall()
-        oldRequests = [r[0] for r in results if datetime.now() > datetime.strptime(r[1], "%d.%m.%Y")]
-        for reqId in oldRequests:
-            sql = "DELETE FROM requests WHERE id=" + str(reqId)
-            self.cur.execute(sql)
-        self.conn.commit()
-
-    @db_lock
+        count = 0
+        while True:
+            deleted = self.DeleteExpiredRequests(self.ExpiryBatchSize)
+            count += len(deleted)
+            if len(deleted) < self.ExpiryBatchSize:
+                return count
+
+    def DeleteExpiredRequests(self, limit: int):
+        self.cur.execute(Queries.GetRequestsEndedBy, (datetime.now().strftime(DateFormat), limit))
+        reqs = [Request.FromRow(r) for r in self.cur.fetchall()]
+        if len(reqs) == 0:
+            return reqs
+        self.cur.executemany(Queries.DeleteRequest, [(req.id,) for req in reqs])
+        self.__Commit()
+        self.__UpdateRequestsCount(-self.cur.rowcount)
+        self.__OnRequestsDeleted([req.id for req in reqs])
+        return reqs
+
+    def GetRequestsEndDates(self):
+        self.cur.execute(Queries.GetRequestsEndDates)
+        return [(r[0], parse_date(r[1])) for r in self.cur.fetchall()]
+
+    def GetAllRawRequests(self):
+        self.cur.execute(Queries.GetAllRequests)
+        return [Request.FromRow(r) for r in self.cur.fetchall()]
+
+    def GetOpenVolume(self):
+        # one pass over the (currency, requestType, ..., quantity) search index, the table is not read
+        self.cur.execute(Queries.GetOpenVolume)
+        return [(r[0], RequestType(r[1]), r[2], r[3]) for r in self.cur.fetchall()]
+
+    def GetRequestsExpiringWithin(self, hours: float):
+        now = datetime.now()
+        self.cur.execute(
+            Queries.GetRequestsEndingBetween,
+            (now.strftime(DateFormat), (now + timedelta(hours=hours)).strftime(DateFormat)),
+        )
+        return [Request.FromRow(r) for r in self.cur.fetchall()]
+
     def GetMasterChatId(self):
-        sql = "SELECT chatId FROM masterchat"
-        self.cur.execute(sql)
+        self.cur.execute(Queries.GetMasterChat)
         result = self.cur.fetchone()
         if result and len(result) > 0:
             return int(result[0])
         return 0
 
-    @db_lock
     def SetMasterChatId(self, chatId):
-        sql = "INSERT INTO masterchat(chatId) VALUES({})".format(chatId)
-        self.cur.execute(sql)
-        self.conn.commit()
+        self.cur.execute(Queries.AddMasterChat, (chatId,))
+        self.__Commit()
 
-    @db_lock
     def IsUserRegistered(self, username):
-        sql = "SELECT count(*) FROM users WHERE username=\"{}\"".format(username)
-        self.cur.execute(sql)
+        self.cur.execute(Queries.CountUsersWithName, (username,))
         result = self.cur.fetchone()
         if not result[0]:
             return False
         return True
 
-    @db_lock
     def AddUser(self, username):
-        sql = "INSERT INTO users(username) VALUES(\"{}\")".format(username)
-        self.cur.execute(sql)
-        self.conn.commit()
+        self.cur.execute(Queries.AddUser, (username,))
+        self.__Commit()
 
-    @db_lock
     def DeleteUser(self, username):
-        sql = "DELETE FROM users WHERE username=\"{}\"".format(username)
-        self.cur.execute(sql)
-        sql = "DELETE FROM requests WHERE username=\"{}\"".format(username)
-        self.cur.execute(sql)
-        sql = "DELETE FROM notifications WHERE username=\"{}\"".format(username)
-        self.cur.execute(sql)
-        sql = "DELETE FROM users_votes WHERE username=\"{}\"".format(username)
-        self.cur.execute(sql)
-        sql = "DELETE FROM users_votes WHERE votedUser=\"{}\"".format(username)
-        self.cur.execute(sql)
-        sql = "DELETE FROM users_languages WHERE username=\"{}\"".format(username)
-        self.cur.execute(sql)
-        self.conn.commit()
-
-    @db_lock
+        self.cur.execute(Queries.GetRequestIdsForUser, (username,))
+        reqIds = [r[0] for r in self.cur.fetchall()]
+        self.cur.execute(Queries.DeleteUser, (username,))
+        self.cur.execute(Queries.DeleteRequestsForUser, (username,))
+        deletedRequests = self.cur.rowcount
+        self.cur.execute(Queries.DeleteNotificationsForUser, (username,))
+        self.cur.execute(Queries.DecrementEscrowScoresByVoter, (username,))
+        self.cur.execute(Queries.DeleteVotesByUser, (username,))
+        self.cur.execute(Queries.DeleteVotesForUser, (username,))
+        self.cur.execute(Queries.DeleteEscrowScore, (username,))
+        self.cur.execute(Queries.DeleteEmptyEscrowScores)
+        self.cur.execute(Queries.DeleteUserLanguage, (username,))
+        self.cur.execute(Queries.DeleteSession, (username,))
+        self.__Commit()
+        self.__AfterCommit(self.languageCache.Invalidate, username)
+        self.__InvalidateEscrowList()
+        self.__UpdateRequestsCount(-deletedRequests)
+        self.__OnRequestsDeleted(reqIds)
+
     def UpdateUser(self, username, userId):
-        sql = "UPDATE users SET userId={0}, username=\"{1}\" WHERE username=\"{1}\" OR userId={0}".format(
-            userId, username
-        )
-        self.cur.execute(sql)
-        self.conn.commit()
+        self.cur.execute(Queries.UpdateUser, (userId, username, username, userId))
+        self.__Commit()
 
-    @db_lock
     def AddUserToBlackListByReqId(self, reqId: int):
-        sql = "SELECT username FROM requests WHERE id={0}".format(reqId)
-        self.cur.execute(sql)
+        self.cur.execute(Queries.GetRequestOwner, (reqId,))
         result = self.cur.fetchall()
         if len(result) == 0:
             return
         username = str(result[0][0])
-        sql = "SELECT userId FROM users WHERE username = \"{0}\"".format(username)
-        self.cur.execute(sql)
+        self.cur.execute(Queries.GetUserId, (username,))
         result = self.cur.fetchone()
-        if result is not None and result[0] is not None:
-            userId = int(result[0])
-            if userId != 0:
-                sql = "INSERT OR IGNORE INTO users_blacklist(userId) VALUES({0})".format(userId)
-                self.cur.execute(sql)
-        self.conn.commit()
-        self.DeleteUser(username)
-
-    @db_lock
+        with self.Transaction():
+            if result is not None and result[0] is not None:
+                userId = int(result[0])
+                if userId != 0:
+                    self.cur.execute(Queries.AddToBlacklist, (userId,))
+            self.DeleteUser(username)
+
     def IsUserInBlacklist(self, userId):
-        sql = "SELECT count(*) FROM users_blacklist WHERE userId={0}".format(userId)
-        self.cur.execute(sql)
+        self.cur.execute(Queries.CountBlacklistedUserId, (userId,))
         count = self.cur.fetchone()
         return count[0] > 0
 
-    @db_lock
     def GetVotesCount(self, username):
-        sql = "SELECT count(*) FROM users_votes WHERE username = \"{}\"".format(username)
-        self.cur.execute(sql)
+        self.cur.execute(Queries.CountVotesByUser, (username,))
         result = self.cur.fetchone()
         return result[0]
 
-    @db_lock
     def IsAlreadyVotedByUser(self, username, votedUser):
-        sql = "SELECT count(*) FROM users_votes WHERE username = \"{0}\" AND votedUser = \"{1}\"".format(
-            username, votedUser
-        )
-        self.cur.execute(sql)
+        self.cur.execute(Queries.CountVote, (username, votedUser))
         result = self.cur.fetchone()
         return result[0] > 0
 
-    @db_lock
     def Vote(self, username, votedUser):
         if not self.IsUserRegistered(username) or self.IsAlreadyVotedByUser(username, votedUser):
             return False
-        sql = "INSERT INTO users_votes(username, votedUser) VALUES(\"{0}\",\"{1}\")".format(username, votedUser)
-        self.cur.execute(sql)
-        self.conn.commit()
+        self.cur.execute(Queries.AddVote, (username, votedUser))
+        if self.cur.rowcount == 0:
+            self.__Commit()
+            return False
+        self.cur.execute(Queries.IncrementEscrowScore, (votedUser,))
+        if self.cur.rowcount == 0:
+            self.cur.execute(Queries.AddEscrowScore, (votedUser,))
+        self.__Commit()
+        self.__InvalidateEscrowList()
         return True
 
-    @db_lock
     def Unvote(self, username, votedUser):
-        sql = "DELETE FROM users_votes WHERE username = \"{0}\" AND votedUser = \"{1}\"".format(username, votedUser)
-        self.cur.execute(sql)
-        self.conn.commit()
+        self.cur.execute(Queries.DeleteVote, (username, votedUser))
+        if self.cur.rowcount > 0:
+            self.cur.execute(Queries.DecrementEscrowScore, (votedUser,))
+            self.cur.execute(Queries.DeleteEmptyEscrowScores)
+        self.__Commit()
+        self.__InvalidateEscrowList()
 
-    @db_lock
     def GetMyVotedUsers(self, username):
-        sql = "SELECT votedUser FROM users_votes WHERE username = \"{}\"".format(username)
-        self.cur.execute(sql)
+        self.cur.execute(Queries.GetVotedUsers, (username,))
         result = self.cur.fetchall()
         usersList = [r[0] for r in result]
         return usersList
 
-    @db_lock
     def GetEscrowList(self):
-        sql = "SELECT votedUser FROM users_votes"
-        self.cur.execute(sql)
-        result = self.cur.fetchall()
-        escrowDic = {}
-        for r in result:
-            if r[0] in escrowDic:
-                escrowDic[r[0]] += 1
-            else:
-                escrowDic[r[0]] = 1
-        sortedDic = sorted(escrowDic.items(), key=lambda x: x[1], reverse=True)
-        return [self.EscrowListTemplate.format(v[0], v[1]) for v in sortedDic]
+        # escrow_scores is kept up to date by Vote/Unvote/DeleteUser, the formatted top is cached until the next vote
+        with self.__escrowLock:
+            if self.__escrowList is not None:
+                return self.__escrowList
+            version = self.__escrowVersion
+        self.cur.execute(Queries.GetTopEscrowScores, (self.EscrowListSize,))
+        escrowList = [self.EscrowListTemplate.format(r[0], r[1]) for r in self.cur.fetchall()]
+        with self.__escrowLock:
+            if version == self.__escrowVersion:
+                self.__escrowList = escrowList
+        return escrowList
 
-    @db_lock
     def SetUserLanguage(self, username, language):
-        sql = "UPDATE users_languages SET language=\"{0}\" WHERE username=\"{1}\"".format(int(language), username)
-        self.cur.execute(sql)
-        self.conn.commit()
+        self.cur.execute(Queries.UpdateUserLanguage, (int(language), username))
+        if self.cur.rowcount == 0:
+            self.cur.execute(Queries.AddUserLanguage, (username, int(language)))
+        self.__Commit()
+        self.__AfterCommit(self.languageCache.Set, username, int(language))
+
+    def RegisterUser(self, username, userId, chatId):
+        # called for every private message; a known user with unchanged ids costs one read and no write
+        self.cur.execute(Queries.GetUserIds, (username,))
+        row = self.cur.fetchone()
+        if row is not None and row[0] == chatId and row[1] == userId:
+            return
+        with self.Transaction():
+            if row is None:
+                self.AddUser(username)
+            self.SetUserChatId(username, chatId)
+            self.UpdateUser(username, userId)
 
-    @db_lock
     def SetUserChatId(self, username, chatId):
-        sql = "UPDATE users SET chatId={0} WHERE username=\"{1}\"".format(chatId, username)
-        self.cur.execute(sql)
-        self.conn.commit()
+        self.cur.execute(Queries.UpdateUserChatId, (chatId, username))
+        self.__Commit()
 
-    @db_lock
     def GetUserChatId(self, username):
-        sql = "SELECT chatId FROM users WHERE username=\"{0}\"".format(username)
-        self.cur.execute(sql)
+        self.cur.execute(Queries.GetUserChatId, (username,))
         row = self.cur.fetchone()
         return row[0]
 
-    @db_lock
-    def IsRequestProcessing(self, reqId):
-        sql = "SELECT count(*) FROM processing_requests WHERE reqId={0}".format(reqId)
-        self.cur.execute(sql)
+    def ClaimRequest(self, reqId, seller, buyer, claimant, expiresAt: datetime):
+        # the UNIQUE index on reqId decides between concurrent claims: exactly one INSERT OR FAIL succeeds.
+        # An expired claim is dropped in the same transaction so it does not block the request
+        try:
+            self.cur.execute(Queries.DeleteExpiredProcessingRequest, (reqId, datetime.now().strftime(DateFormat)))
+            self.cur.execute(
+                Queries.AddProcessingRequest, (reqId, seller, buyer, expiresAt.strftime(DateFormat), claimant)
+            )
+            claimed = True
+        except sqlite3.IntegrityError:
+            # OR FAIL keeps the DELETE, which cannot have removed anything while another claim is active
+            claimed = False
+        self.__Commit()
+        return claimed
+
+    def GetProcessingRequest(self, reqId):
+        # None when the request is not claimed or its claim has expired
+        self.cur.execute(Queries.GetProcessingRequest, (reqId, datetime.now().strftime(DateFormat)))
         row = self.cur.fetchone()
-        return row[0] > 0
+        if row is None:
+            return None
+        return ProcessingRequest.FromRow(row)
 
-    @db_lock
-    def AddProcessingRequest(self, reqId, seller, buyer):
-        sql = "INSERT INTO processing_requests (reqId, seller, buyer) VALUES ({0},\"{1}\",\"{2}\")".format(
-            reqId, seller, buyer
-        )
-        self.cur.execute(sql)
-        self.conn.commit()
+    def FinishProcessingRequest(self, reqId):
+        # only one caller gets True, so a deal is completed once even on repeated clicks
+        self.cur.execute(Queries.DeleteActiveProcessingRequest, (reqId, datetime.now().strftime(DateFormat)))
+        self.__Commit()
+        return self.cur.rowcount > 0
 
-    @db_lock
-    def GetProcessingRequest(self, reqId):
-        sql = "SELECT * FROM processing_requests WHERE reqId={0}".format(reqId)
-        self.cur.execute(sql)
-        rows = self.cur.fetchall()
-        if len(rows) > 0:
-            return tuple(rows[0])
-        return tuple()
+    def ReleaseExpiredProcessingRequest(self, reqId):
+        # returns the claimant of the released claim, or None when it was finished or is not expired yet
+        now = datetime.now().strftime(DateFormat)
+        self.cur.execute(Queries.GetExpiredProcessingRequestClaimant, (reqId, now))
+        row = self.cur.fetchone()
+        if row is None:
+            return None
+        self.cur.execute(Queries.DeleteExpiredProcessingRequest, (reqId, now))
+        self.__Commit()
+        return row[0] if self.cur.rowcount > 0 else None
 
-    @db_lock
-    def DeleteProcessingRequest(self, reqId):
-        sql = "DELETE FROM processing_requests WHERE reqId={0}".format(reqId)
-        self.cur.execute(sql)
-        self.conn.commit()
+    def GetProcessingRequestsExpiry(self):
+        self.cur.execute(Queries.GetProcessingRequestsExpiry)
+        return [(r[0], parse_date(r[1])) for r in self.cur.fetchall()]
+
+    def SaveSession(self, username, chatId, state: str):
+        self.cur.execute(Queries.SaveSession, (username, chatId, state, datetime.now().strftime(DateFormat)))
+        self.__Commit()
+
+    def GetSession(self, username):
+        self.cur.execute(Queries.GetSession, (username,))
+        row = self.cur.fetchone()
+        if row is None:
+            return None
+        return tuple(row)
+
+    def DeleteSession(self, username):
+        self.cur.execute(Queries.DeleteSession, (username,))
+        self.__Commit()
 
-    @db_lock
     def GetUsersCount(self):
-        sql = "SELECT count(*) FROM users"
-        self.cur.execute(sql)
+        self.cur.execute(Queries.CountUsers)
         row = self.cur.fetchone()
         return row[0]
 
-    @db_lock
     def GetUsersCountWithNotifications(self):
-        sql = "SELECT count(*) FROM notifications"
-        self.cur.execute(sql)
+        self.cur.execute(Queries.CountNotifications)
         row = self.cur.fetchone()
         return row[0]
 
     def __FillAssetsTable(self):
+        self.cur.execute("CREATE TABLE IF NOT EXISTS assets (assetName TEXT)")
+        self.cur.execute("DELETE FROM assets")
         self.cur.executemany('INSERT INTO assets (assetName) VALUES (?)', config.assets)
+        self.__Commit()
 
-    def __AddChatIdColumnToUsersTable(self):
-        sql = "PRAGMA table_info('users')"
-        self.cur.execute(sql)
-        result = self.cur.fetchall()
-        if len(result) > 1 and 'chatId' in result[1]:
+    def __Commit(self):
+        local = self.__Connect()
+        if local.depth > 0:
             return
-        sql = "ALTER TABLE users ADD COLUMN chatId INTEGER"
-        self.cur.execute(sql)
-        self.conn.commit()
-
-    def __BlacklistMigration(self):
-        sql = "CREATE TABLE IF NOT EXISTS users_blacklist (userId INTEGER, UNIQUE(userId))"
-        self.cur.execute(sql)
-        sql = "PRAGMA table_info('users')"
-        self.cur.execute(sql)
-        result = self.cur.fetchall()
-        if len(result) > 2 and 'userId' in result[2]:
+        callbacks, local.afterCommit = local.afterCommit, []
+        local.conn.commit()
+        for callback, args in callbacks:
+            callback(*args)
+
+    def __AfterCommit(self, callback, *args):
+        # counters, caches and listeners only see writes once they are committed
+        local = self.__Connect()
+        if local.depth > 0:
+            local.afterCommit.append((callback, args))
+        else:
+            callback(*args)
+
+    def __UpdateRequestsCount(self, delta: int):
+        self.__AfterCommit(self.__AddRequestsCount, delta)
+
+    def __AddRequestsCount(self, delta: int):
+        with self.__countLock:
+            self.__requestsCount += delta
+
+    def __InvalidateEscrowList(self):
+        self.__AfterCommit(self.__ResetEscrowList)
+
+    def __ResetEscrowList(self):
+        with self.__escrowLock:
+            self.__escrowList = None
+            self.__escrowVersion += 1
+
+    def __OnRequestSaved(self, reqId):
+        if len(self.__requestsListeners) == 0:
             return
-        sql = "ALTER TABLE users ADD COLUMN userId INTEGER DEFAULT 0"
-        self.cur.execute(sql)
-        self.conn.commit()
+        self.__AfterCommit(self.__NotifyListeners, "OnRequestSaved", self.GetRawRequest(reqId))
 
-    def __getResultsForSql(self, sql, callUser):
-        self.cur.execute(sql)
-        result = self.cur.fetchall()
-        results = []
-
-        for r in result:
-            number = r[0]
-            username = r[1]
-            reqType = self.__getLocalizedRequestType(RequestType(r[2]), callUser)
-            quantity = r[3]
-            currency = r[4]
-            fee = str(r[6]).replace(",", ".")
-            bank = r[5]
-            startDate = r[7]
-            endDate = r[8]
-            whoPayFee = ""
-            if float(fee) > 0:
-                whoPayFee = ld.get_translate(self, callUser, ld.FeePayBuyerKey)
-            elif float(fee) < 0:
-                whoPayFee = ld.get_translate(self, callUser, ld.FeePaySellerKey)
-            req = ld.get_translate(self, callUser, ld.RequestResultStringTemplate).format(
-                number, username, reqType, quantity, currency, fee, whoPayFee, bank, startDate, endDate
-            )
-            results.append(req)
+    def __OnRequestsDeleted(self, reqIds):
+        if len(reqIds) == 0:
+            return
+        self.__AfterCommit(self.__NotifyListeners, "OnRequestsDeleted", reqIds)
 
-        return results
+    def __NotifyListeners(self, event: str, arg):
+        for listener in self.__requestsListeners:
+            getattr(listener, event)(arg)
 
-    def __getLocalizedRequestType(self, reqType: RequestType, callUser):
-        if reqType == RequestType.Buy:
-            return ld.get_translate(self, callUser, ld.BuyKey).lower()
-        else:
-            return ld.get_translate(self, callUser, ld.SellKey).lower()
-
-    def __cleanup_db(self):
-        sqls = [
-            "DELETE FROM requests WHERE username NOT IN (SELECT username FROM users)",
-            "DELETE FROM notifications WHERE username NOT IN(SELECT username FROM users)",
-            "DELETE FROM users_votes WHERE username NOT IN(SELECT username FROM users)",
-            "DELETE FROM users_votes WHERE votedUser NOT IN(SELECT username FROM users)",
-            "DELETE FROM users_languages WHERE username NOT IN(SELECT username FROM users)",
-        ]
-        for sql in sqls:
-            self.cur.execute(sql)
-        self.conn.commit()
+    def __Migrate(self):
+        version = self.cur.execute("PRAGMA user_version").fetchone()[0]
+        for idx in range(version, len(Migrations)):
+            self.cur.execute("BEGIN")
+            try:
+                Migrations[idx](self.cur)
+                self.cur.execute("PRAGMA user_version={0}".format(idx + 1))
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+
+    def RenderRequests(self, reqs: list, callUser):
+        language = self._GetUserLanguage(callUser)
+        return [self.requestRenderer.Render(req, language) for req in reqs]
+
+    def __getCardsForSql(self, callUser, sql, params=()):
+        # rows are fetched before the language lookup reuses the cursor
+        self.cur.execute(sql, params)
+        reqs = [Request.FromRow(r) for r in self.cur.fetchall()]
+        return list(zip(reqs, self.RenderRequests(reqs, callUser)))
 
     def _GetUserLanguage(self, username):
-        sql = "SELECT count(*) FROM users_languages WHERE username=\"{}\"".format(username)
-        self.cur.execute(sql)
+        version = self.languageCache.version
+        userLang = self.languageCache.Get(username)
+        if userLang is not None:
+            return userLang
+        self.cur.execute(Queries.GetUserLanguage, (username,))
         result = self.cur.fetchone()
-        userLang = ld.DefaultLanguage
-        if result[0] > 0:
-            sql = "SELECT language FROM users_languages WHERE username = \"{}\"".format(username)
-            self.cur.execute(sql)
-            result2 = self.cur.fetchone()
-            return int(result2[0])
+        if result is not None:
+            userLang = int(result[0])
         else:
-            sql = "INSERT INTO users_languages(username, language) VALUES(\"{0}\",\"{1}\")".format(
-                username, int(userLang)
-            )
-            self.cur.execute(sql)
-            self.conn.commit()
+            userLang = int(ld.DefaultLanguage)
+            self.cur.execute(Queries.AddUserLanguage, (username, userLang))
+            self.__Commit()
+        self.languageCache.AddIfUnchanged(username, userLang, version)
         return userLang
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+
+import argparse
+import csv
+import json
+import sys
+import time
+
+import database
+
+Formats = ("ndjson", "csv")
+
+
+def write_rows(stream, fmt: str, columns: tuple, rows) -> int:
+    count = 0
+    if fmt == "csv":
+        writer = csv.writer(stream)
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+        return count
+    for row in rows:
+        stream.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False))
+        stream.write("\n")
+        count += 1
+    return count
+
+
+def read_rows(stream, fmt: str, columns: tuple):
+    # yields tuples in the order of columns; missing values and empty csv fields become NULL
+    if fmt == "csv":
+        for record in csv.DictReader(stream):
+            yield tuple(record.get(c) or None for c in columns)
+        return
+    for line in stream:
+        if line.strip():
+            record = json.loads(line)
+            yield tuple(record.get(c) for c in columns)
+
+
+def open_file(path: str, mode: str):
+    if path == "-":
+        return sys.stdin if mode == "r" else sys.stdout
+    return open(path, mode, encoding="utf-8", newline="" if mode == "w" else None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import bot data. Import while the bot is stopped.")
+    parser.add_argument("command", choices=("export", "import"))
+    parser.add_argument("table", choices=sorted(database.ExportTables))
+    parser.add_argument("file", nargs="?", default="-", help="file to write or read, - for stdout/stdin")
+    parser.add_argument("--format", choices=Formats, default=None, help="defaults to the file extension or ndjson")
+    args = parser.parse_args()
+    fmt = args.format or ("csv" if args.file.endswith(".csv") else "ndjson")
+    columns = database.ExportTables[args.table][1]
+
+    db = database.DB()
+    started = time.monotonic()
+    if args.command == "export":
+        stream = open_file(args.file, "w")
+        try:
+            count = write_rows(stream, fmt, columns, db.ExportTable(args.table))
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+        action = "Exported"
+    else:
+        stream = open_file(args.file, "r")
+        try:
+            count = db.ImportTable(args.table, read_rows(stream, fmt, columns))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        action = "Imported"
+    print("{0} {1} {2} rows in {3:.1f}s".format(action, count, args.table, time.monotonic() - started), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import logging
+import queue
+import threading
+import time
+
+log = logging.getLogger('bot')
+
+
+class _Shard:
+    def __init__(self, idx: int, maxQueueSize: int, bucketsCount: int):
+        self.idx = idx
+        self.queue = queue.Queue(maxQueueSize)
+        self.processed = 0
+        self.failed = 0
+        self.histogram = [0] * bucketsCount
+        self.thread = None
+
+
+class UpdateDispatcher:
+    # updates of one user always land on the same shard and are handled in arrival order,
+    # different users are spread over the shards and handled in parallel
+    ShardsCount = 8
+    MaxQueueSize = 1000
+    LatencyBuckets = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float("inf"))
+
+    def __init__(self):
+        self.__shards = [_Shard(idx, self.MaxQueueSize, len(self.LatencyBuckets)) for idx in range(self.ShardsCount)]
+        self.__lock = threading.Lock()
+
+    def Start(self):
+        for shard in self.__shards:
+            shard.thread = threading.Thread(
+                target=self.__Work, args=(shard,), name="dispatcher-{0}".format(shard.idx), daemon=True
+            )
+            shard.thread.start()
+
+    def Stop(self, timeout: float = 10.0):
+        for shard in self.__shards:
+            shard.queue.put(None)
+        for shard in self.__shards:
+            if shard.thread is not None:
+                shard.thread.join(timeout)
+
+    def Submit(self, userId: int, handler, *args):
+        # blocks while the shard queue is full, which slows down update intake instead of growing memory
+        self.__shards[hash(userId) % self.ShardsCount].queue.put((handler, args))
+
+    def GetMetrics(self):
+        with self.__lock:
+            return [
+                {
+                    "shard": shard.idx,
+                    "queued": shard.queue.qsize(),
+                    "processed": shard.processed,
+                    "failed": shard.failed,
+                    "histogram": list(shard.histogram),
+                }
+                for shard in self.__shards
+            ]
+
+    def __Work(self, shard: _Shard):
+        while True:
+            task = shard.queue.get()
+            if task is None:
+                return
+            handler, args = task
+            startedAt = time.monotonic()
+            failed = False
+            try:
+                handler(*args)
+            except Exception as ex:
+                failed = True
+                log.exception("Exception in {0}: {1}".format(handler.__name__, str(ex)))
+            elapsed = time.monotonic() - startedAt
+            with self.__lock:
+                shard.processed += 1
+                if failed:
+                    shard.failed += 1
+                for idx, bound in enumerate(self.LatencyBuckets):
+                    if elapsed <= bound:
+                        shard.histogram[idx] += 1
+                        break
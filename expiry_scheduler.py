@@ -0,0 +1,59 @@
+import logging
+from datetime import datetime, timedelta
+
+import database
+from timer_service import TimerService
+
+log = logging.getLogger('bot')
+
+
+class ExpiryScheduler:
+    # every open request has a timer at its endDate on the shared TimerService. A due timer deletes all expired
+    # requests in batches, and their listeners cancel the timers of the others deleted with it. A failed delete
+    # is retried by a sweep timer with a growing delay, while the request timers stay with the requests
+    TimerKind = "expiry"
+    RetryDelay = 5
+    MaxRetryDelay = 300
+
+    def __init__(self, db: database.DB, timers: TimerService, onExpired=None):
+        self.__db = db
+        self.__timers = timers
+        self.__onExpired = onExpired
+        self.__retryDelay = self.RetryDelay
+
+    def Start(self):
+        self.__timers.Register(self.TimerKind, self.__OnDue)
+        # requests that expired while the bot was down are due now, they do not count as firing lag
+        now = datetime.now()
+        endDates = self.__db.GetRequestsEndDates()
+        for reqId, endDate in endDates:
+            self.__timers.Schedule(self.TimerKind, reqId, max(endDate, now))
+        log.info("Expiry scheduler loaded {0} requests".format(len(endDates)))
+        self.__db.AddRequestsListener(self)
+
+    def OnRequestSaved(self, req: database.Request):
+        self.__timers.Schedule(self.TimerKind, req.id, req.endDate)
+
+    def OnRequestsDeleted(self, reqIds: list):
+        for reqId in reqIds:
+            self.__timers.Cancel(self.TimerKind, reqId)
+
+    def __OnDue(self, reqId):
+        try:
+            self.__DeleteExpired()
+        except Exception as ex:
+            log.info("Exception during deleting expired requests: " + str(ex))
+            self.__timers.Schedule(self.TimerKind, None, datetime.now() + timedelta(seconds=self.__retryDelay))
+            self.__retryDelay = min(self.__retryDelay * 2, self.MaxRetryDelay)
+            return
+        self.__retryDelay = self.RetryDelay
+
+    def __DeleteExpired(self):
+        while True:
+            rows = self.__db.DeleteExpiredRequests(database.DB.ExpiryBatchSize)
+            if len(rows) > 0:
+                log.info("Deleted {0} expired requests".format(len(rows)))
+                if self.__onExpired is not None:
+                    self.__onExpired(rows)
+            if len(rows) < database.DB.ExpiryBatchSize:
+                return
@@ -48,6 +48,7 @@ NotificationsDisabledKey = "NotificationsDisabledKey"
 NotificationsEnabledKey = "NotificationsEnabledKey"
 WrongInputKey = "WrongInputKey"
 EnterBankNameKey = "EnterBankNameKey"
+BankNameTooLongKey = "BankNameTooLongKey"
 EnterReqDurationKey = "EnterReqDurationKey"
 SuccessfulRequestKey = "SuccessfulRequestKey"
 NewReqNotifKey = "NewReqNotifKey"
@@ -72,6 +73,10 @@ RequestWasSentKey = "RequestWasSentKey"
 RequestHasBeenAcceptedBothSidesKey = "RequestHasBeenAcceptedBothSidesKey"
 AcceptRequestHasBeenAutoCancelledKey = "AcceptRequestHasBeenAutoCancelledKey"
 AcceptRequestNoLongerActiveKey = "AcceptRequestNoLongerActiveKey"
+RequestExpiredKey = "RequestExpiredKey"
+SearchKey = "SearchKey"
+SearchUsageKey = "SearchUsageKey"
+MatchFoundKey = "MatchFoundKey"
 
 _dic = [
     {
@@ -122,6 +127,7 @@ Enter the username you want to vote for.""",
         NobodyKey: "Nobody",
         EnterFeeMsgKey: "Enter fee:",
         EnterBankNameKey: "Enter bank name. You can also add additional info here if need.",
+        BankNameTooLongKey: "Bank name and additional info should be at most {0} characters long",
         EnterReqDurationKey: "Enter request duration in days",
         SuccessfulRequestKey: "Your request was successfully added",
         NewReqNotifKey: """<b>New request</b>
@@ -159,6 +165,14 @@ You can make a deal directly or using garantee.
 To view the list of garantors press click the appropriate button in start menu""",
         AcceptRequestHasBeenAutoCancelledKey: "Your accept request was auto cancelled",
         AcceptRequestNoLongerActiveKey: "This accept request is no longer active",
+        RequestExpiredKey: "Your request #{0} has expired and was removed",
+        SearchKey: "Search requests",
+        SearchUsageKey: """<b>Search</b>
+/search currency [buy|sell] [min-max] [fee:none|fee:seller|fee:buyer] [fee&lt;=N] [sort:fee|sort:new]
+
+Example: /search BTS sell 100-500 fee&lt;=2 sort:fee""",
+        MatchFoundKey: """<b>Matching request for your request #{0}</b>
+{1}""",
     },
     {
         EnglishKey: "(EN) English",
@@ -208,6 +222,7 @@ To view the list of garantors press click the appropriate button in start menu""
         NobodyKey: "Никто",
         EnterFeeMsgKey: "Введите проценты:",
         EnterBankNameKey: "Введите название банка. Вы также можете ввести дополнительную информацию сюда же, если нужно.",
+        BankNameTooLongKey: "Название банка с дополнительной информацией должно быть не длиннее {0} символов",
         EnterReqDurationKey: "Введите длительность заявки в днях",
         SuccessfulRequestKey: "Ваша заявка успешно добавлена",
         NewReqNotifKey: """<b>Новая заявка</b>
@@ -245,10 +260,22 @@ To view the list of garantors press click the appropriate button in start menu""
 Для просмотра списка гарантов нажмите соответствующую кнопку в стартовом меню""",
         AcceptRequestHasBeenAutoCancelledKey: "Ваш запрос был автоматически отменен",
         AcceptRequestNoLongerActiveKey: "Этот запрос уже не активен",
+        RequestExpiredKey: "Срок действия вашей заявки №{0} истек, она была удалена",
+        SearchKey: "Поиск заявок",
+        SearchUsageKey: """<b>Поиск</b>
+/search валюта [купить|продать] [от-до] [fee:none|fee:seller|fee:buyer] [fee&lt;=N] [sort:fee|sort:new]
+
+Пример: /search BTS продать 100-500 fee&lt;=2 sort:fee""",
+        MatchFoundKey: """<b>Подходящая заявка для вашей заявки №{0}</b>
+{1}""",
     },
 ]
 
 
+def get_language_strings(lang):
+    return _dic[lang]
+
+
 def get_translate(db, username, key):
     lang = db._GetUserLanguage(username)
     dic = _dic[lang]
@@ -0,0 +1,95 @@
+import bisect
+import logging
+import threading
+
+import database
+
+log = logging.getLogger('bot')
+
+
+class MatchingEngine:
+    # per currency and side the open orders are kept sorted by (quantity, id), so a new order finds its
+    # counter-orders with a binary search and walks outwards only over the orders it can match. The books are
+    # plain lists: the search is O(log n), but placing or removing an order shifts the tail and is O(n)
+    MatchTolerance = 0.1
+    MaxMatches = 3
+
+    def __init__(self, db: database.DB, onMatch=None):
+        self.__db = db
+        self.__onMatch = onMatch
+        self.__lock = threading.Lock()
+        self.__books = {}
+        self.__orders = {}
+        self.matchesFound = 0
+
+    def Start(self):
+        with self.__lock:
+            for req in self.__db.GetAllRawRequests():
+                self.__Add(req)
+        log.info("Matching engine loaded {0} orders".format(len(self.__orders)))
+        self.__db.AddRequestsListener(self)
+
+    def OnRequestSaved(self, req: database.Request):
+        with self.__lock:
+            self.__Remove(req.id)
+            self.__Add(req)
+            matches = self.__FindMatches(req)
+            self.matchesFound += len(matches)
+        if len(matches) > 0 and self.__onMatch is not None:
+            try:
+                self.__onMatch((req.id, req.username), [(m.id, m.username) for m in matches])
+            except Exception as ex:
+                log.info("Exception during notifying about matches of request {0}: {1}".format(req.id, str(ex)))
+
+    def OnRequestsDeleted(self, reqIds: list):
+        with self.__lock:
+            for reqId in reqIds:
+                self.__Remove(reqId)
+
+    def GetOrdersCount(self):
+        with self.__lock:
+            return len(self.__orders)
+
+    def __GetBook(self, currency, reqType):
+        sides = self.__books.get(currency)
+        if sides is None:
+            sides = self.__books[currency] = {database.RequestType.Buy: [], database.RequestType.Sell: []}
+        return sides[reqType]
+
+    def __Add(self, req: database.Request):
+        bisect.insort(self.__GetBook(req.currency, req.reqType), (req.quantity, req.id))
+        self.__orders[req.id] = req
+
+    def __Remove(self, reqId):
+        order = self.__orders.pop(reqId, None)
+        if order is None:
+            return
+        book = self.__GetBook(order.currency, order.reqType)
+        idx = bisect.bisect_left(book, (order.quantity, order.id))
+        if idx < len(book) and book[idx][1] == reqId:
+            del book[idx]
+
+    def __FindMatches(self, order: database.Request):
+        counterType = (
+            database.RequestType.Sell if order.reqType == database.RequestType.Buy else database.RequestType.Buy
+        )
+        book = self.__GetBook(order.currency, counterType)
+        delta = order.quantity * self.MatchTolerance
+        low = bisect.bisect_left(book, (order.quantity, 0)) - 1
+        high = low + 1
+        matches = []
+        # closest quantities first, stopping as soon as both directions leave the tolerance window
+        while len(matches) < self.MaxMatches:
+            lowOk = low >= 0 and order.quantity - book[low][0] <= delta
+            highOk = high < len(book) and book[high][0] - order.quantity <= delta
+            if not lowOk and not highOk:
+                break
+            if highOk and (not lowOk or book[high][0] - order.quantity <= order.quantity - book[low][0]):
+                counter = self.__orders[book[high][1]]
+                high += 1
+            else:
+                counter = self.__orders[book[low][1]]
+                low -= 1
+            if counter.username != order.username:
+                matches.append(counter)
+        return matches
@@ -0,0 +1,209 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+import telebot
+from telebot.apihelper import ApiTelegramException
+
+log = logging.getLogger('bot')
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.__tokens = capacity
+        self.__updatedAt = time.monotonic()
+        self.__lock = threading.Lock()
+
+    def Acquire(self):
+        while True:
+            with self.__lock:
+                now = time.monotonic()
+                self.__tokens = min(self.capacity, self.__tokens + (now - self.__updatedAt) * self.rate)
+                self.__updatedAt = now
+                if self.__tokens >= 1:
+                    self.__tokens -= 1
+                    return
+                wait = (1 - self.__tokens) / self.rate
+            time.sleep(wait)
+
+
+class _Notification:
+    __slots__ = ("chatId", "text", "parseMode", "enqueuedAt", "attempts")
+
+    def __init__(self, chatId, text, parseMode):
+        self.chatId = chatId
+        self.text = text
+        self.parseMode = parseMode
+        self.enqueuedAt = time.monotonic()
+        self.attempts = 0
+
+
+class Notifier:
+    # Telegram allows about 30 messages per second overall and one message per second to the same chat
+    GlobalRate = 25
+    PerChatInterval = 1.0
+    WorkersCount = 4
+    MaxAttempts = 5
+    LatencySamples = 1000
+
+    def __init__(self, bot: telebot.TeleBot, db):
+        self.__bot = bot
+        self.__db = db
+        self.__bucket = TokenBucket(self.GlobalRate, self.GlobalRate)
+        self.__heap = []
+        self.__seq = itertools.count()
+        self.__cond = threading.Condition()
+        self.__chatNextSlot = {}
+        self.__pausedUntil = 0.0
+        self.__stopped = False
+        self.__workers = []
+        self.__latencies = deque(maxlen=self.LatencySamples)
+        self.__inFlight = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.unsubscribed = 0
+
+    def Start(self):
+        for idx in range(self.WorkersCount):
+            worker = threading.Thread(target=self.__Work, name="notifier-{0}".format(idx), daemon=True)
+            worker.start()
+            self.__workers.append(worker)
+
+    def Stop(self, timeout: float = 10.0):
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notify_all()
+        for worker in self.__workers:
+            worker.join(timeout)
+
+    def Notify(self, chatIds, text: str, parseMode: str = "HTML"):
+        with self.__cond:
+            for chatId in chatIds:
+                self.__Push(_Notification(chatId, text, parseMode), time.monotonic())
+            self.__cond.notify_all()
+
+    def GetMetrics(self):
+        with self.__cond:
+            queued = len(self.__heap)
+            inFlight = self.__inFlight
+            latencies = sorted(self.__latencies)
+        metrics = {
+            "queued": queued,
+            "inFlight": inFlight,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "unsubscribed": self.unsubscribed,
+            "latencyAvg": 0.0,
+            "latencyP95": 0.0,
+            "latencyMax": 0.0,
+        }
+        if latencies:
+            metrics["latencyAvg"] = sum(latencies) / len(latencies)
+            metrics["latencyP95"] = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            metrics["latencyMax"] = latencies[-1]
+        return metrics
+
+    def __Push(self, notification: _Notification, notBefore: float):
+        heapq.heappush(self.__heap, (notBefore, next(self.__seq), notification))
+
+    def __Schedule(self, notification: _Notification, delay: float):
+        with self.__cond:
+            self.__Push(notification, time.monotonic() + delay)
+            self.__cond.notify()
+
+    def __Pop(self):
+        with self.__cond:
+            while True:
+                if self.__stopped:
+                    return None
+                now = time.monotonic()
+                if self.__heap:
+                    wait = max(self.__heap[0][0], self.__pausedUntil) - now
+                    if wait <= 0:
+                        notification = heapq.heappop(self.__heap)[2]
+                        self.__inFlight += 1
+                        return notification
+                    self.__cond.wait(wait)
+                else:
+                    self.__cond.wait()
+
+    def __ReserveChatSlot(self, chatId):
+        with self.__cond:
+            now = time.monotonic()
+            nextSlot = self.__chatNextSlot.get(chatId, 0.0)
+            if nextSlot > now:
+                return nextSlot - now
+            self.__chatNextSlot[chatId] = now + self.PerChatInterval
+            if len(self.__chatNextSlot) > 10000:
+                self.__chatNextSlot = {k: v for k, v in self.__chatNextSlot.items() if v > now}
+            return 0.0
+
+    def __Work(self):
+        while True:
+            notification = self.__Pop()
+            if notification is None:
+                return
+            try:
+                delay = self.__ReserveChatSlot(notification.chatId)
+                if delay > 0:
+                    self.__Schedule(notification, delay)
+                    continue
+                self.__bucket.Acquire()
+                self.__Deliver(notification)
+            finally:
+                with self.__cond:
+                    self.__inFlight -= 1
+
+    def __Deliver(self, notification: _Notification):
+        notification.attempts += 1
+        try:
+            self.__bot.send_message(notification.chatId, notification.text, parse_mode=notification.parseMode)
+        except ApiTelegramException as ex:
+            if ex.error_code == 429:
+                retryAfter = self.__GetRetryAfter(ex)
+                log.info("Notifications are rate limited for {0}s".format(retryAfter))
+                with self.__cond:
+                    self.__pausedUntil = max(self.__pausedUntil, time.monotonic() + retryAfter)
+                self.__Retry(notification, retryAfter)
+            elif ex.error_code == 403 or (ex.error_code == 400 and "chat not found" in ex.description):
+                log.info("Unsubscribing chat {0} from notifications: {1}".format(notification.chatId, ex.description))
+                self.__db.DeleteUserFromNotificationsByChatId(notification.chatId)
+                with self.__cond:
+                    self.unsubscribed += 1
+            elif ex.error_code >= 500:
+                self.__Retry(notification, 2 ** notification.attempts)
+            else:
+                log.info("Exception during send notification: " + str(ex))
+                with self.__cond:
+                    self.failed += 1
+        except Exception as ex:
+            log.info("Exception during send notification: " + str(ex))
+            self.__Retry(notification, 2 ** notification.attempts)
+        else:
+            with self.__cond:
+                self.sent += 1
+                self.__latencies.append(time.monotonic() - notification.enqueuedAt)
+
+    def __Retry(self, notification: _Notification, delay: float):
+        with self.__cond:
+            if notification.attempts >= self.MaxAttempts:
+                log.info("Dropping notification to chat {0}".format(notification.chatId))
+                self.failed += 1
+                return
+            self.retried += 1
+            self.__Push(notification, time.monotonic() + delay)
+            self.__cond.notify()
+
+    @staticmethod
+    def __GetRetryAfter(ex: ApiTelegramException):
+        try:
+            return float(ex.result_json["parameters"]["retry_after"])
+        except (KeyError, TypeError, ValueError):
+            return 1.0
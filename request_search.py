@@ -0,0 +1,97 @@
+import re
+
+import database as db
+from database import FeeFilter
+
+
+class RequestSearch:
+    # /search BTS sell 100-500 fee:seller fee<=2 sort:fee
+    SideWords = {
+        "buy": db.RequestType.Buy,
+        "купить": db.RequestType.Buy,
+        "sell": db.RequestType.Sell,
+        "продать": db.RequestType.Sell,
+    }
+    FeeWords = {
+        "fee:none": FeeFilter.Nobody,
+        "fee:seller": FeeFilter.Seller,
+        "fee:buyer": FeeFilter.Buyer,
+    }
+    __maxFeeRegex = re.compile(r"^fee<=?(\d+(?:[.,]\d+)?)$")
+
+    def __init__(
+        self,
+        currency: str,
+        requestType: db.RequestType = None,
+        minQuantity: int = None,
+        maxQuantity: int = None,
+        feeFilter: FeeFilter = FeeFilter.Any,
+        maxFee: float = None,
+        sortByFee: bool = False,
+    ):
+        self.currency = currency
+        self.requestType = requestType
+        self.minQuantity = minQuantity
+        self.maxQuantity = maxQuantity
+        self.feeFilter = feeFilter
+        self.maxFee = maxFee
+        self.sortByFee = sortByFee
+
+    @property
+    def feeAscending(self):
+        # cheapest first for the searching side: buyers look for sellers paying the most, sellers for buyers
+        return self.requestType != db.RequestType.Buy
+
+    @classmethod
+    def Parse(cls, text: str, assets: list):
+        tokens = text.split()
+        if len(tokens) > 0 and tokens[0].startswith("/search"):
+            tokens = tokens[1:]
+        assetsByName = {a.upper(): a for a in assets}
+        search = cls(None)
+        for token in tokens:
+            word = token.lower()
+            maxFeeMatch = cls.__maxFeeRegex.match(word)
+            if token.upper() in assetsByName:
+                search.currency = assetsByName[token.upper()]
+            elif word in cls.SideWords:
+                search.requestType = cls.SideWords[word]
+            elif word in cls.FeeWords:
+                search.feeFilter = cls.FeeWords[word]
+            elif word == "sort:fee" or word == "sort:new":
+                search.sortByFee = word == "sort:fee"
+            elif maxFeeMatch:
+                search.maxFee = float(maxFeeMatch.group(1).replace(",", "."))
+            elif "-" in word and word != "-":
+                # quantity range, either bound may be omitted and units are allowed: 1k-5k, 100-, -2.5m
+                low, high = word.split("-", 1)
+                search.minQuantity = db.parse_quantity(low) if low else None
+                search.maxQuantity = db.parse_quantity(high) if high else None
+            else:
+                raise ValueError("Unexpected search term: " + token)
+        if search.currency is None:
+            raise ValueError("Currency is required")
+        return search
+
+    def GetState(self):
+        return {
+            "currency": self.currency,
+            "requestType": None if self.requestType is None else int(self.requestType),
+            "minQuantity": self.minQuantity,
+            "maxQuantity": self.maxQuantity,
+            "feeFilter": int(self.feeFilter),
+            "maxFee": self.maxFee,
+            "sortByFee": self.sortByFee,
+        }
+
+    @classmethod
+    def FromState(cls, state: dict):
+        return cls(
+            state["currency"],
+            None if state["requestType"] is None else db.RequestType(state["requestType"]),
+            state["minQuantity"],
+            state["maxQuantity"],
+            FeeFilter(state["feeFilter"]),
+            state["maxFee"],
+            state["sortByFee"],
+        )
@@ -0,0 +1,89 @@
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import telebot
+
+import database
+from notifier import Notifier
+from timer_service import TimerService
+from user_request_process import UserRequestProcess
+
+log = logging.getLogger('bot')
+
+
+class SessionStore:
+    MaxSessions = 5000
+    IdleTimeout = 30 * 60
+
+    def __init__(self, bot: telebot.TeleBot, db: database.DB, notifier: Notifier, timers: TimerService):
+        self.__bot = bot
+        self.__db = db
+        self.__notifier = notifier
+        self.__timers = timers
+        self.__sessions = OrderedDict()
+        self.__lock = threading.Lock()
+        self.hits = 0
+        self.restored = 0
+        self.evicted = 0
+
+    def Get(self, username, chatId=None):
+        # returns the live session, rehydrates a persisted one, or creates a new one when chatId is given
+        with self.__lock:
+            session = self.__sessions.get(username)
+            if session is not None:
+                self.__sessions.move_to_end(username)
+                self.__sessions[username] = (session[0], time.monotonic())
+                self.hits += 1
+                return session[0]
+
+        process = self.__Restore(username)
+        if process is None:
+            if chatId is None:
+                return None
+            process = UserRequestProcess(self.__bot, self.__db, self.__notifier, self.__timers, username, chatId)
+
+        with self.__lock:
+            session = self.__sessions.get(username)
+            if session is not None:
+                process = session[0]
+            self.__sessions[username] = (process, time.monotonic())
+            self.__sessions.move_to_end(username)
+            self.__Evict()
+        return process
+
+    def Save(self, process: UserRequestProcess):
+        self.__db.SaveSession(process.username, process.chatId, json.dumps(process.GetState()))
+
+    def Remove(self, username):
+        with self.__lock:
+            self.__sessions.pop(username, None)
+        self.__db.DeleteSession(username)
+
+    def __len__(self):
+        return len(self.__sessions)
+
+    def __Restore(self, username):
+        row = self.__db.GetSession(username)
+        if row is None:
+            return None
+        process = UserRequestProcess(self.__bot, self.__db, self.__notifier, self.__timers, username, row[0])
+        try:
+            process.SetState(json.loads(row[1]))
+        except Exception as ex:
+            log.info("Exception during restoring session of {0}: {1}".format(username, str(ex)))
+            return process
+        self.restored += 1
+        return process
+
+    def __Evict(self):
+        # sessions are persisted after every update, so evicting only drops the in-memory copy
+        idleSince = time.monotonic() - self.IdleTimeout
+        while len(self.__sessions) > 0:
+            username, (process, lastAccess) = next(iter(self.__sessions.items()))
+            if len(self.__sessions) <= self.MaxSessions and lastAccess >= idleSince:
+                return
+            del self.__sessions[username]
+            self.evicted += 1
@@ -0,0 +1,102 @@
+import heapq
+import logging
+import threading
+from datetime import datetime
+
+log = logging.getLogger('bot')
+
+
+class TimerService:
+    # one thread and one heap for every timer of the bot. Timers are plain (kind, arg) data, handlers are
+    # registered once per kind, so nothing keeps a session alive and pending timers can be rebuilt from the DB
+    # after a restart. Cancelled or rescheduled entries are dropped lazily and compacted once they dominate
+    CompactionRatio = 2
+
+    def __init__(self):
+        self.__handlers = {}
+        self.__heap = []
+        self.__deadlines = {}
+        self.__cond = threading.Condition()
+        self.__stopped = False
+        self.__thread = None
+        self.fired = 0
+        self.cancelled = 0
+        self.__lagTotal = 0.0
+        self.__lagMax = 0.0
+
+    def Register(self, kind: str, handler):
+        self.__handlers[kind] = handler
+
+    def Start(self):
+        self.__thread = threading.Thread(target=self.__Run, name="timers", daemon=True)
+        self.__thread.start()
+
+    def Stop(self):
+        with self.__cond:
+            self.__stopped = True
+            self.__cond.notify()
+        if self.__thread is not None:
+            self.__thread.join()
+
+    def Schedule(self, kind: str, arg, dueAt: datetime):
+        # scheduling an existing (kind, arg) again moves it to the new time
+        handle = (kind, arg)
+        with self.__cond:
+            self.__deadlines[handle] = dueAt
+            heapq.heappush(self.__heap, (dueAt, handle))
+            if self.__heap[0][1] == handle:
+                self.__cond.notify()
+            self.__CompactIfNeeded()
+        return handle
+
+    def Cancel(self, kind: str, arg):
+        with self.__cond:
+            if self.__deadlines.pop((kind, arg), None) is not None:
+                self.cancelled += 1
+            self.__CompactIfNeeded()
+
+    def GetMetrics(self):
+        with self.__cond:
+            return {
+                "pending": len(self.__deadlines),
+                "fired": self.fired,
+                "cancelled": self.cancelled,
+                "lagAvg": self.__lagTotal / self.fired if self.fired > 0 else 0.0,
+                "lagMax": self.__lagMax,
+            }
+
+    def __CompactIfNeeded(self):
+        if len(self.__heap) > self.CompactionRatio * len(self.__deadlines) + 64:
+            self.__heap = [(dueAt, handle) for handle, dueAt in self.__deadlines.items()]
+            heapq.heapify(self.__heap)
+
+    def __Run(self):
+        while True:
+            with self.__cond:
+                handle = self.__WaitForDue()
+                if handle is None:
+                    return
+            try:
+                self.__handlers[handle[0]](handle[1])
+            except Exception as ex:
+                log.info("Exception in timer {0}: {1}".format(handle, str(ex)))
+
+    def __WaitForDue(self):
+        while not self.__stopped:
+            while self.__heap and self.__deadlines.get(self.__heap[0][1]) != self.__heap[0][0]:
+                heapq.heappop(self.__heap)
+            if not self.__heap:
+                self.__cond.wait()
+                continue
+            dueAt, handle = self.__heap[0]
+            wait = (dueAt - datetime.now()).total_seconds()
+            if wait <= 0:
+                heapq.heappop(self.__heap)
+                del self.__deadlines[handle]
+                lag = -wait
+                self.fired += 1
+                self.__lagTotal += lag
+                self.__lagMax = max(self.__lagMax, lag)
+                return handle
+            self.__cond.wait(wait)
+        return None
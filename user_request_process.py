@@ -1,19 +1,15 @@
 import logging
-import threading
 from datetime import datetime, timedelta
 from enum import IntEnum
 
 import telebot
-from telebot.types import (
-    InlineKeyboardButton,
-    InlineKeyboardMarkup,
-    KeyboardButton,
-    ReplyKeyboardMarkup,
-    ReplyKeyboardRemove,
-)
+from telebot.types import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
 
 import database as db
 import localizationdic as ld
+from notifier import Notifier
+from request_search import RequestSearch
+from timer_service import TimerService
 
 log = logging.getLogger('bot')
 
@@ -43,8 +39,45 @@ class FeeTypes(IntEnum):
 
 
 class UserRequestProcess:
+    PageSize = 5
+    MaxMessageLength = 4096
+    AcceptTimeout = 300
+    AcceptTimerKind = "accept"
+    SearchNextPageData = "SearchNextPage"
+    SearchPrevPageData = "SearchPrevPage"
+    # one instance per live session, so there is no per-instance __dict__
+    __slots__ = (
+        "username",
+        "currentStep",
+        "__bot",
+        "__db",
+        "__notifier",
+        "__timers",
+        "__chatId",
+        "__reqType",
+        "__quantity",
+        "__currency",
+        "__fee",
+        "__bank",
+        "__daysQuantity",
+        "__reqIdForUpdate",
+        "__startDate",
+        "__endDate",
+        "__startMsgId",
+        "__processMsgId",
+        "__unvoteMsgId",
+        "__pageMsgId",
+        "__search",
+        "__searchCursors",
+        "__searchNextCursor",
+        "__feeType",
+        "__currentPage",
+        "__pageFirstId",
+        "__pageLastId",
+        "__isKeyboardActive",
+    )
     __reqType: db.RequestType
-    __quantity: str
+    __quantity: int
     __currency: str
     __feeType: FeeTypes
     __fee: float
@@ -54,26 +87,104 @@ class UserRequestProcess:
     __startDate: datetime
     __endDate: datetime
     __currentPage: int
+    __pageFirstId: int
+    __pageLastId: int
     __startMsgId: int
     __processMsgId: int
     __unvoteMsgId: int
-    __allReqMsgIds: list
+    __pageMsgId: int
+    __search: RequestSearch
+    __searchCursors: list
+    __searchNextCursor: list
     __isKeyboardActive: bool
 
-    def __init__(self, bot: telebot.TeleBot, db: db.DB, username, chatId):
+    def __init__(self, bot: telebot.TeleBot, db: db.DB, notifier: Notifier, timers: TimerService, username, chatId):
         self.username = username
         self.currentStep = RequestSteps.Start
         self.__bot = bot
         self.__db = db
+        self.__notifier = notifier
+        self.__timers = timers
         self.__chatId = chatId
+        self.__reqType = None
+        self.__quantity = None
+        self.__currency = None
+        self.__fee = 0.0
+        self.__bank = None
+        self.__daysQuantity = -1
+        self.__reqIdForUpdate = None
+        self.__startDate = None
+        self.__endDate = None
         self.__startMsgId = -1
         self.__processMsgId = -1
         self.__unvoteMsgId = -1
-        self.__allReqMsgIds = []
+        self.__pageMsgId = -1
+        self.__search = None
+        self.__searchCursors = ()
+        self.__searchNextCursor = None
         self.__feeType = -1
         self.__currentPage = 0
+        self.__pageFirstId = 0
+        self.__pageLastId = 0
         self.__isKeyboardActive = False
 
+    @property
+    def chatId(self):
+        return self.__chatId
+
+    def GetState(self):
+        return {
+            "currentStep": int(self.currentStep),
+            "reqType": None if self.__reqType is None else int(self.__reqType),
+            "quantity": self.__quantity,
+            "currency": self.__currency,
+            "feeType": int(self.__feeType),
+            "fee": self.__fee,
+            "bank": self.__bank,
+            "daysQuantity": self.__daysQuantity,
+            "reqIdForUpdate": self.__reqIdForUpdate,
+            "startDate": None if self.__startDate is None else self.__startDate.strftime(db.DateFormat),
+            "endDate": None if self.__endDate is None else self.__endDate.strftime(db.DateFormat),
+            "currentPage": self.__currentPage,
+            "pageFirstId": self.__pageFirstId,
+            "pageLastId": self.__pageLastId,
+            "startMsgId": self.__startMsgId,
+            "processMsgId": self.__processMsgId,
+            "unvoteMsgId": self.__unvoteMsgId,
+            "pageMsgId": self.__pageMsgId,
+            "search": None if self.__search is None else self.__search.GetState(),
+            "searchCursors": list(self.__searchCursors),
+            "searchNextCursor": self.__searchNextCursor,
+            "isKeyboardActive": self.__isKeyboardActive,
+        }
+
+    def SetState(self, state: dict):
+        self.currentStep = RequestSteps(state["currentStep"])
+        self.__reqType = None if state["reqType"] is None else db.RequestType(state["reqType"])
+        self.__quantity = state["quantity"]
+        if isinstance(self.__quantity, str):
+            self.__quantity = db.parse_quantity(self.__quantity)
+        self.__currency = state["currency"]
+        self.__feeType = state["feeType"] if state["feeType"] < 0 else FeeTypes(state["feeType"])
+        self.__fee = state["fee"]
+        self.__bank = state["bank"]
+        self.__daysQuantity = state["daysQuantity"]
+        self.__reqIdForUpdate = state["reqIdForUpdate"]
+        self.__startDate = None if state["startDate"] is None else db.parse_date(state["startDate"])
+        self.__endDate = None if state["endDate"] is None else db.parse_date(state["endDate"])
+        self.__currentPage = state["currentPage"]
+        self.__pageFirstId = state.get("pageFirstId", 0)
+        self.__pageLastId = state.get("pageLastId", 0)
+        self.__startMsgId = state["startMsgId"]
+        self.__processMsgId = state["processMsgId"]
+        self.__unvoteMsgId = state["unvoteMsgId"]
+        self.__pageMsgId = state.get("pageMsgId", -1)
+        search = state.get("search")
+        self.__search = None if search is None else RequestSearch.FromState(search)
+        self.__searchCursors = () if self.__search is None else list(state.get("searchCursors", [None]))
+        self.__searchNextCursor = state.get("searchNextCursor")
+        self.__isKeyboardActive = state["isKeyboardActive"]
+
     def Start(self):
         self.currentStep = RequestSteps.Start
         self.__currentPage = 0
@@ -92,6 +203,9 @@ class UserRequestProcess:
                 ld.get_translate(self.__db, self.username, ld.ShowAllReqKey), callback_data=ld.ShowAllReqKey
             ),
         )
+        keyboard.row(
+            InlineKeyboardButton(ld.get_translate(self.__db, self.username, ld.SearchKey), callback_data=ld.SearchKey)
+        )
         keyboard.row(
             InlineKeyboardButton(ld.get_translate(self.__db, self.username, ld.VoteKey), callback_data=ld.VoteKey),
             InlineKeyboardButton(ld.get_translate(self.__db, self.username, ld.UnvoteKey), callback_data=ld.UnvoteKey),
@@ -145,7 +259,19 @@ class UserRequestProcess:
         handler(msg)
 
     def __ProcessStartState(self, msg: str):
-        self.__deleteAllReqMessages()
+        if msg == ld.NextPageKey or msg == "➡️":
+            self.__ProcessShowAll(1)
+            return
+        elif msg == ld.PrevPageKey or msg == "⬅️":
+            self.__ProcessShowAll(-1)
+            return
+        elif msg == self.SearchNextPageData:
+            self.__ProcessSearch(1)
+            return
+        elif msg == self.SearchPrevPageData:
+            self.__ProcessSearch(-1)
+            return
+        self.__deletePageMessage()
         if msg == ld.SellKey:
             log.info(self.username + " Sell")
             self.__deleteAllReqKeyboard()
@@ -198,13 +324,13 @@ class UserRequestProcess:
                 self.currentStep = RequestSteps.ChangeCurrency
                 self.__reqIdForUpdate = parseResult[1]
                 req = self.__db.GetRawRequest(parseResult[1])
-                self.__reqType = db.RequestType(req[2])
-                self.__quantity = str(req[3])
-                self.__currency = req[4]
-                self.__fee = float(req[6])
-                self.__bank = req[5]
-                self.__startDate = datetime.strptime(req[7], "%d.%m.%Y")
-                self.__endDate = datetime.strptime(req[8], "%d.%m.%Y")
+                self.__reqType = req.reqType
+                self.__quantity = req.quantity
+                self.__currency = req.currency
+                self.__fee = req.fee
+                self.__bank = req.bankName
+                self.__startDate = req.startDate
+                self.__endDate = req.endDate
                 self.__daysQuantity = (self.__endDate - self.__startDate).days
                 self.__deleteStartMessage()
                 assets = self.__db.GetAssetsList()
@@ -222,16 +348,26 @@ class UserRequestProcess:
             self.__ProcessShowMy()
         elif msg == ld.ShowAllReqKey:
             log.info(self.username + " browsing all requests")
-            self.__currentPage = 1
-            self.__ProcessShowAll(self.__currentPage)
-        elif msg == "➡️":
-            self.__currentPage += 1
-            self.__ProcessShowAll(self.__currentPage)
-        elif msg == "⬅️":
-            self.__currentPage -= 1
-            if self.__currentPage < 1:
-                self.__currentPage = 1
-            self.__ProcessShowAll(self.__currentPage)
+            self.__ProcessShowAll(0)
+        elif msg == ld.SearchKey:
+            self.__deleteAllReqKeyboard()
+            self.__bot.send_message(
+                self.__chatId, ld.get_translate(self.__db, self.username, ld.SearchUsageKey), parse_mode="HTML"
+            )
+        elif msg.startswith("/search"):
+            self.__deleteAllReqKeyboard()
+            try:
+                self.__search = RequestSearch.Parse(msg, self.__db.GetAssetsList())
+            except ValueError as ex:
+                log.info("{0} wrong search {1}: {2}".format(self.username, msg, str(ex)))
+                self.__bot.send_message(
+                    self.__chatId, ld.get_translate(self.__db, self.username, ld.SearchUsageKey), parse_mode="HTML"
+                )
+                return
+            log.info("{0} searching requests: {1}".format(self.username, msg))
+            self.__searchCursors = [None]
+            self.__searchNextCursor = None
+            self.__ProcessSearch(0)
         elif msg == ld.VoteKey:
             self.__deleteAllReqKeyboard()
             if (db.DB.MaxVotes - self.__db.GetVotesCount(self.username)) <= 0:
@@ -301,17 +437,18 @@ class UserRequestProcess:
             try:
                 msg = msg.replace(ld.AcceptBuyRequestKey, "")
                 reqNum = int(msg.replace(ld.AcceptSellRequestKey, ""))
-                if self.__db.IsRequestProcessing(reqNum):
+                req = self.__db.GetRawRequest(reqNum)
+                buyer = self.username if req.reqType == db.RequestType.Sell else req.username
+                seller = req.username if req.reqType == db.RequestType.Sell else self.username
+                expiresAt = datetime.now() + timedelta(seconds=self.AcceptTimeout)
+                if not self.__db.ClaimRequest(reqNum, seller, buyer, self.username, expiresAt):
                     self.__bot.send_message(
                         self.__chatId, ld.get_translate(self.__db, self.username, ld.RequestAlreadyAcceptedKey)
                     )
                     return
-                req = self.__db.GetRawRequest(reqNum)
-                reqType = db.RequestType(req[2])
-                buyer = self.username if reqType == db.RequestType.Sell else req[1]
-                seller = req[1] if reqType == db.RequestType.Sell else self.username
-                self.__db.AddProcessingRequest(reqNum, seller, buyer)
-                reqUserChatId = self.__db.GetUserChatId(req[1])
+                # the claim holds the request from now on, so its timeout must not depend on the sends below
+                self.__timers.Schedule(self.AcceptTimerKind, reqNum, expiresAt)
+                reqUserChatId = self.__db.GetUserChatId(req.username)
                 keyboard = InlineKeyboardMarkup(row_width=1)
                 keyboard.row(
                     InlineKeyboardButton(
@@ -321,16 +458,15 @@ class UserRequestProcess:
                 )
                 log.info(
                     "{0}({1}) sent accept message to user {2}({3})".format(
-                        self.username, self.__chatId, req[1], reqUserChatId
+                        self.username, self.__chatId, req.username, reqUserChatId
                     )
                 )
                 self.__bot.send_message(
                     reqUserChatId,
-                    ld.get_translate(self.__db, req[1], ld.RequestWasAcceptedKey).format(reqNum, self.username),
+                    ld.get_translate(self.__db, req.username, ld.RequestWasAcceptedKey).format(reqNum, self.username),
                     reply_markup=keyboard,
                 )
                 self.__bot.send_message(self.__chatId, ld.get_translate(self.__db, self.username, ld.RequestWasSentKey))
-                self.__StartRequestAcceptTimer(reqNum)
             except Exception as ex:
                 log.info("Exception during accepting request: " + str(ex))
 
@@ -339,14 +475,18 @@ class UserRequestProcess:
                 log.info("{0} trying to accept request {1}".format(self.username, msg))
                 reqNum = int(msg.replace(ld.AcceptKey, ""))
                 processingReq = self.__db.GetProcessingRequest(reqNum)
-                if len(processingReq) == 0:
+                if processingReq is None or not self.__db.FinishProcessingRequest(reqNum):
                     log.info("Request is no longer exists")
                     self.__bot.send_message(
                         self.__chatId, ld.get_translate(self.__db, self.username, ld.AcceptRequestNoLongerActiveKey)
                     )
                     return
-                seller = processingReq[1]
-                buyer = processingReq[2]
+                # the deal is done once the claim is finished: drop the request and its timer before notifying
+                self.__timers.Cancel(self.AcceptTimerKind, reqNum)
+                self.__db.DeleteReqWithId(reqNum)
+                log.info("Processing request #{0} was finished".format(reqNum))
+                seller = processingReq.seller
+                buyer = processingReq.buyer
                 sellerChatId = self.__db.GetUserChatId(seller)
                 buyerChatId = self.__db.GetUserChatId(buyer)
                 log.info("Send Finish Accept message to user {0}, chatId {1}".format(seller, sellerChatId))
@@ -359,8 +499,6 @@ class UserRequestProcess:
                     buyerChatId,
                     ld.get_translate(self.__db, buyer, ld.RequestHasBeenAcceptedBothSidesKey).format(reqNum, seller),
                 )
-                self.__DeleteProcessingRequest(reqNum)
-                self.__db.DeleteReqWithId(reqNum)
             except Exception:
                 log.info("Exception during accepting request")
 
@@ -393,10 +531,7 @@ class UserRequestProcess:
             self.Start()
             return
         try:
-            parsedValue = self.__GetNumberFromString(msg)
-            if not parsedValue:
-                raise Exception("Parsing error!")
-            self.__quantity = parsedValue
+            self.__quantity = db.parse_quantity(msg)
             self.currentStep = RequestSteps.EnterFeeType
             keyboard = InlineKeyboardMarkup(row_width=2)
             keyboard.row(
@@ -486,6 +621,9 @@ class UserRequestProcess:
         if len(self.__bank) == 0:
             self.__bot.send_message(self.__chatId, ld.get_translate(self.__db, self.username, ld.WrongInputKey))
             return
+        if len(self.__bank) > db.MaxBankNameLength:
+            self.__sendBankNameTooLong()
+            return
         self.currentStep = RequestSteps.EnterEndDate
         keyboard = InlineKeyboardMarkup(row_width=1)
         keyboard.row(
@@ -558,11 +696,8 @@ class UserRequestProcess:
             return
         if not (msg == ld.SkipKey):
             try:
-                parsedValue = self.__GetNumberFromString(msg)
-                if not parsedValue:
-                    raise Exception("Parsing error!")
-                self.__quantity = parsedValue
-            except Exception:
+                self.__quantity = db.parse_quantity(msg)
+            except ValueError:
                 self.__bot.send_message(self.__chatId, ld.get_translate(self.__db, self.username, ld.WrongInputKey))
                 return
 
@@ -648,7 +783,11 @@ class UserRequestProcess:
             self.Start()
             return
         if not (msg == ld.SkipKey):
-            self.__bank = self.__StripTagsRegex(msg)
+            bank = self.__StripTagsRegex(msg)
+            if len(bank) > db.MaxBankNameLength:
+                self.__sendBankNameTooLong()
+                return
+            self.__bank = bank
 
         self.currentStep = RequestSteps.ChangeEndDate
         keyboard = InlineKeyboardMarkup(row_width=1)
@@ -750,11 +889,7 @@ class UserRequestProcess:
 
     def __SendNotifications(self, message: str):
         forNotif = self.__db.GetUserlistForNotifications(self.username)
-        for chatId in forNotif:
-            try:
-                self.__bot.send_message(chatId, message, parse_mode="HTML")
-            except Exception as ex:
-                log.info("Exception during send notification: " + str(ex))
+        self.__notifier.Notify(forNotif, message)
 
     def __GetMarkupForAssetList(self, assetsList: list, withSkipBtn: bool = False):
         assetsCount = len(assetsList)
@@ -784,16 +919,12 @@ class UserRequestProcess:
         return keyboard
 
     def __ProcessShowMy(self):
-        myReqs = self.__db.GetRequestsFor(self.username, self.username)
+        myReqs = self.__db.GetRequestCardsFor(self.username, self.username)
         if len(myReqs) == 0:
             self.__bot.send_message(self.__chatId, ld.get_translate(self.__db, self.username, ld.EmptyKey))
             return
-        for req in myReqs:
-            idx1 = req.find('(')
-            idx2 = req.find(')')
-            if idx1 < 0 or idx2 < 0:
-                continue
-            reqId = req[idx1 : idx2 + 1]  # noqa: E203
+        for req, text in myReqs:
+            reqId = "({0})".format(req.id)
             keyboard = InlineKeyboardMarkup(row_width=1)
             keyboard.row(
                 InlineKeyboardButton(
@@ -805,78 +936,154 @@ class UserRequestProcess:
                     callback_data="{0} {1}".format(ld.ChangeKey, reqId),
                 ),
             )
-            self.__bot.send_message(self.__chatId, req, parse_mode="HTML", reply_markup=keyboard)
+            self.__bot.send_message(self.__chatId, text, parse_mode="HTML", reply_markup=keyboard)
 
-    def __ProcessShowAll(self, pageNumber: int):
-        limit = 5
-        offset = limit * (pageNumber - 1)
-        allReqs = self.__db.GetAllRequests(self.username, offset, limit)
+    def __ProcessShowAll(self, direction: int):
+        # pages are addressed by the ids on the current page, so deep pages cost the same as the first one
+        limit = self.PageSize
+        pageNumber = self.__currentPage + direction
+        allReqs = []
+        hasNextPage = False
+        if direction > 0 and self.__pageLastId > 0:
+            allReqs = self.__db.GetAllRequests(self.username, self.__pageLastId, limit + 1)
+            if len(allReqs) == 0:
+                self.__bot.send_message(self.__chatId, ld.get_translate(self.__db, self.username, ld.EmptyKey))
+                return
+        elif direction < 0 and pageNumber > 1 and self.__pageFirstId > 0:
+            allReqs = self.__db.GetAllRequestsAfter(self.username, self.__pageFirstId, limit)
+            hasNextPage = True
+        if len(allReqs) == 0 or (direction < 0 and len(allReqs) < limit):
+            pageNumber = 1
+            allReqs = self.__db.GetAllRequests(self.username, 0, limit + 1)
+            hasNextPage = False
+        if len(allReqs) > limit:
+            allReqs = allReqs[:limit]
+            hasNextPage = True
         if len(allReqs) == 0:
             self.__bot.send_message(self.__chatId, ld.get_translate(self.__db, self.username, ld.EmptyKey))
             return
-        for req in allReqs:
-            keyboard = InlineKeyboardMarkup(row_width=1)
-            buttonTextKey = (
-                ld.AcceptSellRequestKey if db.RequestType(req[2]) == db.RequestType.Sell else ld.AcceptBuyRequestKey
-            )
-            keyboard.row(
-                InlineKeyboardButton(
-                    ld.get_translate(self.__db, self.username, buttonTextKey),
-                    callback_data="{0}{1}".format(buttonTextKey, req[0]),
-                )
-            )
-            formattedReq = self.__getFormattedRequest(req)
-            if str(req[1]) == self.username:
-                keyboard = None
-            reply = self.__bot.send_message(self.__chatId, formattedReq, parse_mode="HTML", reply_markup=keyboard)
-            self.__allReqMsgIds.append(reply.message_id)
+        cards = self.__fitPage(allReqs)
+        if len(cards) < len(allReqs):
+            allReqs = allReqs[: len(cards)]
+            hasNextPage = True
+        self.__currentPage = pageNumber
+        self.__pageFirstId = allReqs[0].id
+        self.__pageLastId = allReqs[-1].id
         reqCount = self.__db.GetAllRequestsCount()
-        showPrevButton = pageNumber > 1
-        showNextButton = (reqCount - (limit + limit * (pageNumber - 1))) > 0
-
-        keyboard = None
-        if showNextButton or showPrevButton:
-            keyboard = ReplyKeyboardMarkup(row_width=2, resize_keyboard=True, one_time_keyboard=True)
-            buttons = []
-            if showPrevButton:
-                buttons.append(KeyboardButton("⬅️"))
-            if showNextButton:
-                buttons.append(KeyboardButton("➡️"))
-            keyboard.add(*buttons)
-            self.__isKeyboardActive = True
         maxPageNumber = reqCount // limit
         if reqCount % limit > 0:
             maxPageNumber += 1
-        reply = self.__bot.send_message(
-            self.__chatId, "Page {0} of {1}".format(pageNumber, maxPageNumber), parse_mode="HTML", reply_markup=keyboard
+        maxPageNumber = max(maxPageNumber, pageNumber)
+        self.__ShowRequestsPage(
+            allReqs,
+            cards,
+            "Page {0} of {1}".format(pageNumber, maxPageNumber),
+            pageNumber > 1,
+            hasNextPage,
+            ld.PrevPageKey,
+            ld.NextPageKey,
         )
-        self.__allReqMsgIds.append(reply.message_id)
-
-    def __getFormattedRequest(self, req: tuple):
-        number = req[0]
-        username = req[1]
-        reqType = self.__getLocalizedRequestType(db.RequestType(req[2]), self.username)
-        quantity = req[3]
-        currency = req[4]
-        fee = str(req[6]).replace(",", ".")
-        bank = req[5]
-        startDate = req[7]
-        endDate = req[8]
-        whoPayFee = ""
-        if float(fee) > 0:
-            whoPayFee = ld.get_translate(self.__db, self.username, ld.FeePayBuyerKey)
-        elif float(fee) < 0:
-            whoPayFee = ld.get_translate(self.__db, self.username, ld.FeePaySellerKey)
-        req = ld.get_translate(self.__db, self.username, ld.RequestResultStringTemplate).format(
-            number, username, reqType, quantity, currency, fee, whoPayFee, bank, startDate, endDate
+
+    def __ProcessSearch(self, direction: int):
+        # search pages are addressed by the sort key of their first row, previous pages by the visited keys
+        if self.__search is None:
+            return
+        if direction > 0 and self.__searchNextCursor is not None:
+            self.__searchCursors.append(self.__searchNextCursor)
+        elif direction < 0 and len(self.__searchCursors) > 1:
+            self.__searchCursors.pop()
+        limit = self.PageSize
+        reqs = self.__db.SearchRequests(self.__search, self.__searchCursors[-1], limit + 1)
+        hasNextPage = len(reqs) > limit
+        reqs = reqs[:limit]
+        self.__searchNextCursor = None
+        if len(reqs) == 0:
+            self.__bot.send_message(self.__chatId, ld.get_translate(self.__db, self.username, ld.EmptyKey))
+            return
+        cards = self.__fitPage(reqs)
+        if len(cards) < len(reqs):
+            reqs = reqs[: len(cards)]
+            hasNextPage = True
+        if hasNextPage:
+            self.__searchNextCursor = [reqs[-1].fee, reqs[-1].id] if self.__search.sortByFee else [reqs[-1].id]
+        self.__ShowRequestsPage(
+            reqs,
+            cards,
+            "Page {0}".format(len(self.__searchCursors)),
+            len(self.__searchCursors) > 1,
+            hasNextPage,
+            self.SearchPrevPageData,
+            self.SearchNextPageData,
         )
-        return req
 
-    def __getLocalizedRequestType(self, reqType: db.RequestType, callUser):
-        if reqType == db.RequestType.Buy:
-            return ld.get_translate(self.__db, callUser, ld.BuyKey).lower()
-        else:
-            return ld.get_translate(self.__db, callUser, ld.SellKey).lower()
+    def __fitPage(self, reqs: list):
+        # the cards that fit into one message together with the page title; the rest go to the next page.
+        # Telegram counts the limit in UTF-16 code units, where an emoji takes two
+        cards = []
+        length = 64
+        for card in self.__db.RenderRequests(reqs, self.username):
+            length += len(card.encode("utf-16-le")) // 2 + 2
+            if len(cards) > 0 and length > self.MaxMessageLength:
+                break
+            cards.append(card)
+        return cards
+
+    def __ShowRequestsPage(
+        self,
+        reqs: list,
+        cards: list,
+        pageTitle: str,
+        hasPrevPage: bool,
+        hasNextPage: bool,
+        prevPageData: str,
+        nextPageData: str,
+    ):
+        pageText = "\n\n".join(cards)
+        pageText += "\n\n" + pageTitle
+
+        keyboard = InlineKeyboardMarkup(row_width=2)
+        for req in reqs:
+            if req.username == self.username:
+                continue
+            buttonTextKey = ld.AcceptSellRequestKey if req.reqType == db.RequestType.Sell else ld.AcceptBuyRequestKey
+            keyboard.row(
+                InlineKeyboardButton(
+                    "{0} ({1})".format(ld.get_translate(self.__db, self.username, buttonTextKey), req.id),
+                    callback_data="{0}{1}".format(buttonTextKey, req.id),
+                )
+            )
+        buttons = []
+        if hasPrevPage:
+            buttons.append(
+                InlineKeyboardButton(
+                    ld.get_translate(self.__db, self.username, ld.PrevPageKey), callback_data=prevPageData
+                )
+            )
+        if hasNextPage:
+            buttons.append(
+                InlineKeyboardButton(
+                    ld.get_translate(self.__db, self.username, ld.NextPageKey), callback_data=nextPageData
+                )
+            )
+        if len(buttons) > 0:
+            keyboard.row(*buttons)
+        self.__showPage(pageText, keyboard if len(keyboard.keyboard) > 0 else None)
+
+    def __showPage(self, text: str, keyboard: InlineKeyboardMarkup):
+        # the page is a single message, turning pages edits it in place with one API call
+        if self.__pageMsgId > 0:
+            try:
+                self.__bot.edit_message_text(
+                    text, self.__chatId, self.__pageMsgId, parse_mode="HTML", reply_markup=keyboard
+                )
+                return
+            except Exception as ex:
+                if "message is not modified" in str(ex):
+                    return
+                log.info("Exception during edit requests page message. Error: " + str(ex))
+                self.__deletePageMessage()
+        reply = self.__bot.send_message(self.__chatId, text, parse_mode="HTML", reply_markup=keyboard)
+        self.__pageMsgId = reply.message_id
 
     def __deleteProcessMessage(self):
         if self.__processMsgId > 0:
@@ -894,14 +1101,13 @@ class UserRequestProcess:
             except Exception as ex:
                 log.info("Exception during delete start message. Error: " + str(ex))
 
-    def __deleteAllReqMessages(self):
-        if len(self.__allReqMsgIds) > 0:
-            for msgId in self.__allReqMsgIds:
-                try:
-                    self.__bot.delete_message(self.__chatId, msgId)
-                except Exception as ex:
-                    log.info("Exception during delete all requests message. Error: " + str(ex))
-            self.__allReqMsgIds.clear()
+    def __deletePageMessage(self):
+        if self.__pageMsgId > 0:
+            try:
+                self.__bot.delete_message(self.__chatId, self.__pageMsgId)
+            except Exception as ex:
+                log.info("Exception during delete requests page message. Error: " + str(ex))
+            self.__pageMsgId = -1
 
     def __deleteAllReqKeyboard(self):
         if not self.__isKeyboardActive:
@@ -925,28 +1131,13 @@ class UserRequestProcess:
         except Exception:
             return (False, 0)
 
+    def __sendBankNameTooLong(self):
+        self.__bot.send_message(
+            self.__chatId,
+            ld.get_translate(self.__db, self.username, ld.BankNameTooLongKey).format(db.MaxBankNameLength),
+        )
+
     def __StripTagsRegex(self, source):
         import re
 
         return re.sub("<.*?>", "", source)
-
-    def __GetNumberFromString(self, source):
-        import re
-
-        result = re.findall("([0-9]*[.,][0-9]+|[0-9]+)", source)
-        if len(result) > 0:
-            return result[0]
-        return None
-
-    def __StartRequestAcceptTimer(self, reqId):
-        threading.Timer(300, lambda: self.__AutoDeleteProcessingRequest(reqId)).start()
-
-    def __AutoDeleteProcessingRequest(self, reqId):
-        self.__bot.send_message(
-            self.__chatId, ld.get_translate(self.__db, self.username, ld.AcceptRequestHasBeenAutoCancelledKey)
-        )
-        self.__DeleteProcessingRequest(reqId)
-
-    def __DeleteProcessingRequest(self, reqId):
-        log.info("Processing request #{0} was deleted".format(reqId))
-        self.__db.DeleteProcessingRequest(reqId)
@@ -0,0 +1,95 @@
+import hmac
+import json
+import logging
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import telebot
+from telebot.types import Update
+
+log = logging.getLogger('bot')
+
+
+class WebhookServer:
+    WorkersCount = 8
+    MaxPendingUpdates = 256
+    MaxBodySize = 1024 * 1024
+
+    def __init__(self, bot: telebot.TeleBot, host: str, port: int, path: str, secretToken: str):
+        # the token is the only thing that tells Telegram's requests from anyone else's
+        if not secretToken:
+            raise ValueError("webhook secret_token must be set")
+        self.bot = bot
+        self.path = path
+        self.secretToken = secretToken
+        self.__executor = ThreadPoolExecutor(max_workers=self.WorkersCount, thread_name_prefix="webhook")
+        self.__pending = threading.BoundedSemaphore(self.MaxPendingUpdates)
+        self.__server = ThreadingHTTPServer((host, port), _WebhookRequestHandler)
+        self.__server.daemon_threads = True
+        self.__server.webhook = self
+
+    def Serve(self):
+        # SIGTERM/SIGINT stop accepting updates and let already accepted ones finish
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda *args: threading.Thread(target=self.__server.shutdown).start())
+        log.info("Webhook server is listening on {0}:{1}{2}".format(*self.__server.server_address, self.path))
+        try:
+            self.__server.serve_forever()
+        finally:
+            self.__server.server_close()
+            self.__executor.shutdown(wait=True)
+            log.info("Webhook server stopped")
+
+    def Stop(self):
+        self.__server.shutdown()
+
+    def Submit(self, update: Update):
+        if not self.__pending.acquire(blocking=False):
+            return False
+        future = self.__executor.submit(self.__Process, update)
+        future.add_done_callback(lambda f: self.__pending.release())
+        return True
+
+    def __Process(self, update: Update):
+        try:
+            self.bot.process_new_updates([update])
+        except Exception as ex:
+            log.info("Exception during processing update {0}: {1}".format(update.update_id, str(ex)))
+
+
+class _WebhookRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        webhook = self.server.webhook
+        if self.path != webhook.path:
+            self.__Reply(404)
+            return
+        token = self.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        # compared as bytes: compare_digest rejects non-ASCII str, and a forged header may contain anything
+        if not hmac.compare_digest(token.encode(), webhook.secretToken.encode()):
+            self.__Reply(403)
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            self.__Reply(400)
+            return
+        if length <= 0 or length > WebhookServer.MaxBodySize:
+            self.__Reply(400)
+            return
+        try:
+            update = Update.de_json(json.loads(self.rfile.read(length).decode("utf-8")))
+        except Exception:
+            self.__Reply(400)
+            return
+        # a non-2xx answer makes Telegram redeliver the update later, which is our backpressure
+        self.__Reply(200 if webhook.Submit(update) else 503)
+
+    def log_message(self, format, *args):
+        log.debug("webhook %s - %s", self.address_string(), format % args)
+
+    def __Reply(self, code: int):
+        self.send_response(code)
+        self.send_header("Content-Length", "0")
+        self.end_headers()